@@ -0,0 +1,404 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from DallECore import (settings, key_pool, load_api_modules, count_prompts, extract_concept, PromptTemplate,
+                       build_image_params, log_api_response, get_retry_delay, save_image_details_and_download, build_image_metadata, send_progress, batch_copies, assign_images, get_image_cost, MODEL_NAMES,
+                       DownloadError, RETRYABLE_DOWNLOAD_STATUSES, check_png, get_download_length, get_hedge_delay, get_backoff_delay, PNG_SIGNATURE, PNG_TRAILER,
+                       get_concurrency_controller, reuse_cached_image, clear_created_directories,
+                       get_dataset_directory)
+from DallEJournal import JobJournal, make_job_id
+from DallECache import ImageCache, make_cache_key
+from DallEManifest import flush_manifests
+from DallEMetrics import metrics, start_metrics_export, finish_metrics_export
+from DallEPostprocess import start_postprocessor
+
+logger = logging.getLogger(__name__)
+
+# Queue depths and busy workers of each pipeline stage, readable at any time during a run
+class PipelineMonitor(object):
+    def __init__(self, queues):
+        self.queues = queues
+        self.busy = {name: 0 for name in queues}
+
+    def snapshot(self):
+        return {name: {'queued': queue.qsize(), 'busy': self.busy[name]} for name, queue in self.queues.items()}
+
+    def describe(self):
+        return ", ".join(f"{name} {state['queued']} queued/{state['busy']} busy" for name, state in self.snapshot().items())
+
+    async def report_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            logger.info("Pipeline: %s", self.describe(), extra={'pipeline': self.snapshot()})
+
+# Asyncio generation engine: generate, download and write stages connected by bounded queues
+class AsyncPipeline(object):
+    def __init__(self, base_prompt, variables, quantity, size, quality, model_version, generate_log, generate_caption, conceptify, dataset, concurrency,
+                 journal_path=None, cache_path=None, progress=None, stop_event=None, write_workers=4, report_interval=10.0):
+        self.base_prompt = base_prompt
+        self.variables = variables
+        self.quantity = quantity
+        self.size = size
+        self.quality = quality
+        self.model_version = model_version
+        self.generate_log = generate_log
+        self.generate_caption = generate_caption
+        self.conceptify = conceptify
+        self.dataset = dataset
+        self.concurrency = max(1, concurrency)
+        self.write_workers = max(1, min(write_workers, self.concurrency))
+        self.report_interval = report_interval
+        self.journal = JobJournal(journal_path) if journal_path else None
+        self.cache = ImageCache(cache_path) if cache_path else None
+        self.progress = progress
+        self.stop_event = stop_event
+
+        # Progress of the run
+        self.total_jobs = count_prompts(variables) * quantity if base_prompt else 0
+        self.completed = 0
+        self.skipped = 0
+        self.reused = 0
+        self.submitted = 0
+        self.cancelled = 0
+        self.failed_jobs = []
+        self.job_images = {}  # job_id -> [images still pending, paths saved so far]
+
+    # Function to run the whole pipeline and return (completed, failed_jobs) like run_generation
+    async def run(self):
+        load_api_modules()
+        import openai
+        import httpx
+
+        logger.info("Generating %d images with up to %d requests in flight (asyncio engine).", self.total_jobs, self.concurrency)
+        clear_created_directories()
+        self.exporter = start_metrics_export(settings)
+        self.send_progress('running')
+        self.postprocessor = start_postprocessor(settings)
+
+        # With adaptive concurrency the worker count is only the ceiling, the controller decides how many requests are in flight
+        self.controller = get_concurrency_controller(MODEL_NAMES.get(self.model_version, 'dall-e-3'), self.size, self.quality, self.concurrency)
+        if self.controller:
+            logger.info("Adaptive concurrency for %s starts at %d requests in flight.", self.controller.name, self.controller.current_limit())
+
+        # Bounded queues between the stages keep memory flat however many jobs there are
+        self.generate_queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        self.download_queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        self.write_queue = asyncio.Queue(maxsize=self.write_workers * 2)
+        self.monitor = PipelineMonitor({'generate': self.generate_queue, 'download': self.download_queue, 'write': self.write_queue})
+
+        # Disk writes go to a small thread pool so they never block the event loop
+        self.executor = ThreadPoolExecutor(max_workers=self.write_workers)
+        self.clients = {key.name: openai.AsyncOpenAI(api_key=key.api_key, organization=key.organization, max_retries=0) for key in key_pool.keys}
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        self.http = httpx.AsyncClient(limits=limits, timeout=10)
+        monitor_task = asyncio.create_task(self.monitor.report_loop(self.report_interval))
+        try:
+            # Start the stages downstream first, then shut each one down once the stage before it is done
+            writers = [asyncio.create_task(self.write_worker()) for _ in range(self.write_workers)]
+            downloaders = [asyncio.create_task(self.download_worker()) for _ in range(self.concurrency)]
+            generators = [asyncio.create_task(self.generate_worker()) for _ in range(self.concurrency)]
+            await self.produce_jobs(len(generators))
+            await asyncio.gather(*generators)
+            for _ in downloaders:
+                await self.download_queue.put(None)
+            await asyncio.gather(*downloaders)
+            for _ in writers:
+                await self.write_queue.put(None)
+            await asyncio.gather(*writers)
+        finally:
+            monitor_task.cancel()
+            flush_manifests()
+            if self.postprocessor:
+                self.postprocessor.close()
+            await self.http.aclose()
+            for client in self.clients.values():
+                await client.close()
+            self.executor.shutdown()
+            if self.journal:
+                self.journal.close()
+            if self.cache:
+                self.cache.close()
+
+        self.report()
+        return self.completed, self.failed_jobs
+
+    # Producer: stream the prompts from the template into the generate queue, each prompt's copies batched into as few requests as the model allows
+    async def produce_jobs(self, generator_count):
+        written_job_ids = self.journal.completed_job_ids() if self.journal else set()
+        for prompt, concept_parts in PromptTemplate(self.base_prompt, self.variables).jobs(self.conceptify):
+            if self.stopping():
+                break
+            jobs = []
+            for copy_index in range(self.quantity):
+                job_id = make_job_id(prompt, copy_index, self.model_version, self.size, self.quality, self.dataset)
+                if job_id in written_job_ids:
+                    self.skipped += 1
+                    continue
+                cache_key = make_cache_key(prompt, copy_index, self.model_version, self.size, self.quality) if self.cache else None
+                cached_path = self.cache.lookup(cache_key) if self.cache else None
+                if cached_path:
+                    # A dataset an earlier run already linked this image into keeps that copy, otherwise linking it into
+                    # the output and writing its sidecar files happens on the write pool, off the event loop
+                    dataset_directory = get_dataset_directory(self.dataset)
+                    linked_path = self.cache.lookup_link(cache_key, dataset_directory)
+                    image_path = await asyncio.get_running_loop().run_in_executor(
+                        self.executor, reuse_cached_image, cached_path, prompt, copy_index, job_id, self.model_version, self.size, self.quality,
+                        self.generate_log, self.generate_caption, self.conceptify, self.dataset, concept_parts, self.journal, linked_path)
+                    if image_path:
+                        self.cache.store_link(cache_key, dataset_directory, image_path)
+                        self.reused += 1
+                        if self.postprocessor and image_path not in (cached_path, linked_path):
+                            self.postprocessor.submit(image_path)
+                        continue
+                jobs.append((prompt, copy_index, job_id, cache_key, concept_parts))
+            for batch in batch_copies(jobs, self.model_version):
+                if self.stopping():
+                    break
+                if self.journal:
+                    for job in batch:
+                        self.journal.record(job[2], 'queued', prompt=prompt, copy_index=job[1])
+                await self.generate_queue.put(batch)
+                self.submitted += len(batch)
+        for _ in range(generator_count):
+            await self.generate_queue.put(None)
+
+    # Generate stage: call the Images API once per batch of copies, retrying rate limits and server errors
+    async def generate_worker(self):
+        while True:
+            batch = await self.generate_queue.get()
+            if batch is None:
+                return
+            if self.stopping():
+                # Queued jobs are dropped once a stop is requested, they stay queued in the journal
+                self.cancelled += len(batch)
+                continue
+            self.monitor.busy['generate'] += 1
+            unfinished = list(batch)
+            try:
+                prompt, _, _, _, concept_parts = batch[0]
+                if self.journal:
+                    for job in batch:
+                        self.journal.record(job[2], 'requested')
+                concept, api_prompt = extract_concept(prompt, self.conceptify, concept_parts)
+                params = build_image_params(api_prompt, len(batch), MODEL_NAMES.get(self.model_version, 'dall-e-3'), self.size, self.quality)
+                logger.debug("Making API request with params: %s", params)
+                generate_start = time.monotonic()
+                response = await self.generate_with_retries(params, prompt)
+                if response is None or not response.data:
+                    for job in batch:
+                        self.finish_job(job, [])
+                    continue
+                log_api_response(response)
+                metadata = build_image_metadata(self.model_version, self.size, self.quality, time.monotonic() - generate_start)
+                # Every image in the response is saved, the n-th image belongs to the n-th copy
+                assigned = list(zip(batch, assign_images(response.data, len(batch))))
+                for job, images in assigned:
+                    if images:
+                        self.job_images[job[2]] = [len(images), []]
+                for job, images in assigned:
+                    unfinished.remove(job)
+                    if not images:
+                        self.finish_job(job, [])
+                    for image in images:
+                        await self.download_queue.put((job, concept, image, metadata))
+            except Exception as e:
+                logger.error("Job failed for prompt: '%s' (copies %s): %s", batch[0][0], ', '.join(str(job[1] + 1) for job in unfinished), e, exc_info=True)
+                for job in unfinished:
+                    self.finish_job(job, [])
+            finally:
+                self.monitor.busy['generate'] -= 1
+
+    async def generate_with_retries(self, params, prompt):
+        attempt = 0
+        while True:
+            if self.controller:
+                await self.controller.acquire_async()
+            try:
+                key = await key_pool.acquire_async(params['n'])
+            except RuntimeError as e:
+                logger.error("%s", e)
+                if self.controller:
+                    self.controller.release()
+                return None
+            try:
+                request_start = time.monotonic()
+                metrics.increment('requests')
+                response = await self.clients[key.name].images.generate(**params)
+                latency = time.monotonic() - request_start
+                metrics.record('api', latency)
+                key_pool.release(key, images=len(response.data), cost=get_image_cost(params['model'], params['size'], params['quality']), started=request_start)
+                if self.controller:
+                    self.controller.release(latency)
+                return response
+            except Exception as e:
+                key_pool.release(key, e, started=request_start)
+                if self.controller:
+                    self.controller.release(error=e)
+                delay = get_retry_delay(e, attempt, key)
+                if delay is None:
+                    logger.error("An unexpected error occurred: %s", e)
+                    return None
+                attempt += 1
+                metrics.increment('retries')
+                logger.warning("Request failed (%s), retry %d/%d in %.1fs for prompt: '%s'", e.__class__.__name__, attempt, settings['max_retries'], delay, prompt)
+                await asyncio.sleep(delay)
+
+    # Download stage: fetch URL images over a shared keep-alive connection pool, inline images pass straight through
+    async def download_worker(self):
+        while True:
+            item = await self.download_queue.get()
+            if item is None:
+                return
+            job, concept, image, metadata = item
+            self.monitor.busy['download'] += 1
+            try:
+                image_data = None
+                if not image.b64_json:
+                    request_start = time.monotonic()
+                    image_data = await self.download(image.url)
+                    if image_data is None:
+                        self.finish_image(job, None)
+                        continue
+                    metrics.record('download', time.monotonic() - request_start)
+                await self.write_queue.put((job, concept, image.url, image.b64_json, image_data, metadata))
+            except Exception as e:
+                logger.warning("An error occurred downloading %s: %s", image.url, e)
+                self.finish_image(job, None)
+            finally:
+                self.monitor.busy['download'] -= 1
+
+    # Function to download an image, sending a hedged second request if the first one takes longer than the hedge delay
+    async def download(self, url):
+        primary = asyncio.ensure_future(self.fetch_image(url))
+        hedge_delay = get_hedge_delay()
+        if hedge_delay is None:
+            return await primary
+        done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+        if done:
+            return primary.result()
+        metrics.increment('hedged_downloads')
+        pending = {primary, asyncio.ensure_future(self.fetch_image(url))}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.result() is not None:
+                    # The slower request is no longer needed
+                    for other in pending:
+                        other.cancel()
+                    return task.result()
+        return None
+
+    # Function to fetch an image over the shared keep-alive pool, retrying with backoff and resuming a dropped transfer with a Range request.
+    # Returns the checked image bytes, or None
+    async def fetch_image(self, url):
+        import httpx
+        data = bytearray()
+        attempt = 0
+        while True:
+            try:
+                headers = {'Range': f'bytes={len(data)}-'} if data else {}
+                async with self.http.stream('GET', url, headers=headers) as response:
+                    if response.status_code == 416 and data:
+                        # An earlier attempt already had every byte
+                        expected_length = get_download_length(206, {'content-range': response.headers.get('content-range', '')})
+                    elif response.status_code not in (200, 206):
+                        raise DownloadError(f"status code {response.status_code}", response.status_code in RETRYABLE_DOWNLOAD_STATUSES)
+                    else:
+                        if response.status_code == 200:
+                            data.clear()  # The server ignored the Range header and sends the whole image
+                        expected_length = get_download_length(response.status_code, response.headers, len(data))
+                        async for chunk in response.aiter_bytes():
+                            data.extend(chunk)
+                check_png(bytes(data[:len(PNG_SIGNATURE)]), bytes(data[-len(PNG_TRAILER):]), len(data), expected_length)
+                return bytes(data)
+            except (httpx.HTTPError, DownloadError) as e:
+                if getattr(e, 'restart', False):
+                    data.clear()
+                if not getattr(e, 'retryable', True) or attempt >= settings['download_retries']:
+                    logger.warning("Failed to download the image (%s): %s", e, url)
+                    return None
+                attempt += 1
+                metrics.increment('download_retries')
+                delay = get_backoff_delay(attempt, base=0.5, cap=10.0)
+                logger.info("Download failed (%s), retry %d/%d in %.1fs: %s", e, attempt, settings['download_retries'], delay, url)
+                await asyncio.sleep(delay)
+
+    # Write stage: save the image and its sidecar files on the executor
+    async def write_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.write_queue.get()
+            if item is None:
+                return
+            job, concept, image_url, image_b64, image_data, metadata = item
+            self.monitor.busy['write'] += 1
+            try:
+                image_path = await loop.run_in_executor(self.executor, save_image_details_and_download, image_url, job[0],
+                                                        self.generate_log, self.generate_caption, concept, self.dataset, image_b64, image_data, metadata)
+                self.finish_image(job, image_path)
+            except Exception as e:
+                logger.error("An error occurred writing the image for prompt: '%s': %s", job[0], e, exc_info=True)
+                self.finish_image(job, None)
+            finally:
+                self.monitor.busy['write'] -= 1
+
+    # Function to record one image of a job, the job finishes once all its images are done
+    def finish_image(self, job, image_path):
+        job_id = job[2]
+        pending = self.job_images[job_id]
+        pending[0] -= 1
+        if image_path:
+            pending[1].append(image_path)
+            logger.info("Generated image for prompt: '%s' saved to: %s", job[0], image_path)
+            if self.journal:
+                self.journal.record(job_id, 'downloaded', image_path=image_path)
+        if pending[0] == 0:
+            del self.job_images[job_id]
+            self.finish_job(job, pending[1])
+
+    def finish_job(self, job, saved_paths):
+        prompt, copy_index, job_id, cache_key, _ = job
+        if saved_paths:
+            self.completed += 1
+            if self.journal:
+                self.journal.record(job_id, 'written')
+            if self.cache:
+                self.cache.store(cache_key, prompt, copy_index, self.model_version, self.size, self.quality, saved_paths[0])
+            if self.postprocessor:
+                for image_path in saved_paths:
+                    self.postprocessor.submit(image_path)
+        else:
+            self.failed_jobs.append((prompt, copy_index))
+            metrics.increment('jobs_failed')
+            if self.journal:
+                self.journal.record(job_id, 'failed')
+        logger.info("Progress: %d/%d jobs finished, %d failed.", self.skipped + self.reused + self.completed + len(self.failed_jobs), self.total_jobs, len(self.failed_jobs))
+        self.send_progress('running')
+
+    def stopping(self):
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    def send_progress(self, state):
+        in_flight = self.submitted - self.cancelled - self.completed - len(self.failed_jobs)
+        send_progress(self.progress, state, self.total_jobs, self.completed, len(self.failed_jobs), self.skipped, self.reused, in_flight)
+
+    def report(self):
+        if self.skipped:
+            logger.info("%d jobs were skipped because the journal already had them written.", self.skipped)
+        if self.reused:
+            logger.info("%d jobs reused cached images instead of calling the API.", self.reused)
+        cancelled = self.total_jobs - self.skipped - self.reused - self.completed - len(self.failed_jobs)
+        if cancelled:
+            logger.warning("Stopped: %d queued jobs were cancelled.", cancelled)
+        if self.failed_jobs:
+            logger.warning("%d of %d jobs failed:", len(self.failed_jobs), self.total_jobs)
+            for prompt, copy_index in self.failed_jobs:
+                logger.warning("  - copy %d of prompt: '%s'", copy_index + 1, prompt)
+        finish_metrics_export(self.exporter, settings)
+        self.send_progress('stopped' if cancelled else 'done')
+        logger.info("All images have been processed.")
+
+# Function to run a generation on the asyncio engine, takes the same arguments as run_generation
+def run_async_generation(*args, **kwargs):
+    return asyncio.run(AsyncPipeline(*args, **kwargs).run())
@@ -0,0 +1,85 @@
+import argparse
+import json
+import logging
+import sys
+from DallECore import settings, calculate_cost, count_prompts, run_generation, mark_startup_phase, report_startup
+from DallEMetrics import setup_logging
+
+logger = logging.getLogger('DallEBatch')
+
+# Function to load the jobs from a job file, a single job object or a list of them
+def load_jobs(path):
+    with open(path, 'r', encoding='utf-8') as file:
+        data = json.load(file)
+    jobs = data if isinstance(data, list) else [data]
+
+    # Fill in anything the job file leaves out from settings.ini
+    resolved_jobs = []
+    for job in jobs:
+        if not job.get('prompt', '').strip():
+            raise ValueError(f"Every job needs a 'prompt', got: {job}")
+        resolved_jobs.append({
+            'prompt': job['prompt'].strip(),
+            'variables': {var: [value.strip() for value in values if value.strip()] for var, values in job.get('variables', {}).items()},
+            'model_version': job.get('model_version', settings['model_version']),
+            'size': job.get('size', settings['size']),
+            'quality': job.get('quality', settings['model_mode']),
+            'quantity': int(job.get('quantity', settings['quantity'])),
+            'dataset': job.get('dataset', settings['dataset']),
+            'generate_caption': job.get('generate_caption', settings['generate_caption']),
+            'generate_log': job.get('generate_log', settings['generate_log']),
+            'conceptify': job.get('conceptify', settings['conceptify']),
+            'concurrency': int(job.get('concurrency', settings['concurrency'])),
+        })
+    return resolved_jobs
+
+# Function to count the images and estimate the cost of a job without expanding it
+def estimate_job(job):
+    total_images = count_prompts(job['variables']) * job['quantity']
+    return total_images, calculate_cost(job['model_version'], job['size'], job['quality'], total_images)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate DALL·E images from a job file without the GUI.")
+    parser.add_argument('job_file', help="JSON file with a job object (prompt, variables, model_version, size, quality, quantity, dataset) or a list of them")
+    parser.add_argument('--dry-run', action='store_true', help="Only print the number of images and the estimated cost")
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default=settings['engine'], help="Generation engine: a thread pool, or one asyncio event loop with generate/download/write stages")
+    parser.add_argument('--cache', default=settings['cache'], help="Image cache index; prompt and parameter combinations it already has are reused instead of regenerated")
+    parser.add_argument('--journal', default=settings['journal'], help="SQLite job journal; jobs it already has written are skipped, so an interrupted run can be resumed")
+    parser.add_argument('--shard-depth', type=int, default=settings['shard_depth'], choices=[0, 1, 2], help="Spread images over 256 (1) or 65536 (2) hash-named subfolders, with the dataset's manifest.jsonl as its index")
+    parser.add_argument('--log-level', default=settings['log_level'], choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], type=str.upper, help="Only log messages of this level and above")
+    parser.add_argument('--log-format', default=settings['log_format'], choices=['text', 'json'], help="Log plain text lines or one JSON object per line")
+    parser.add_argument('--metrics-json', default=settings['metrics_json'], help="Write a JSON summary of the latencies, retries, throughput and spend of the run to this file")
+    parser.add_argument('--prometheus-file', default=settings['prometheus_file'], help="Keep the run's metrics in this file in the Prometheus text format while it runs")
+    parser.add_argument('--prometheus-port', type=int, default=settings['prometheus_port'], help="Serve the run's metrics on http://localhost:PORT/metrics while it runs")
+    parser.add_argument('--prometheus-host', default=settings['prometheus_host'], help="Address the metrics endpoint binds to, e.g. 0.0.0.0 to let other machines scrape it")
+    args = parser.parse_args(argv)
+
+    # The command line overrides the layout, logging and metrics settings from settings.ini
+    settings.update(shard_depth=args.shard_depth, log_level=args.log_level, log_format=args.log_format, metrics_json=args.metrics_json,
+                    prometheus_file=args.prometheus_file, prometheus_port=args.prometheus_port, prometheus_host=args.prometheus_host)
+    setup_logging(settings['log_level'], settings['log_format'])
+
+    jobs = load_jobs(args.job_file)
+    mark_startup_phase('job file')
+    report_startup()
+
+    # Log the estimate for every job before spending anything
+    total_failed = 0
+    for index, job in enumerate(jobs, start=1):
+        total_images, total_cost = estimate_job(job)
+        logger.info("Job %d/%d: %d images, approximately $%.2f.", index, len(jobs), total_images, total_cost,
+                    extra={'images': total_images, 'estimated_cost': total_cost})
+        if args.dry_run or not total_images:
+            continue
+
+        _, failed_jobs = run_generation(job['prompt'], job['variables'], job['quantity'], job['size'], job['quality'], job['model_version'],
+                                        job['generate_log'], job['generate_caption'], job['conceptify'], job['dataset'], job['concurrency'],
+                                        journal_path=args.journal or None, cache_path=args.cache or None,
+                                        engine=args.engine)
+        total_failed += len(failed_jobs)
+
+    # A non-zero exit code lets pipelines notice failed images
+    return 1 if total_failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+
+# Function to build the cache key for one generated image from the final prompt and the request parameters
+def make_cache_key(prompt, copy_index, model_version, size, quality):
+    key = json.dumps([prompt, copy_index, model_version, size, quality], ensure_ascii=False)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+# Index of the images already in the output tree, keyed on prompt and request parameters
+class ImageCache(object):
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS images (
+                cache_key TEXT PRIMARY KEY,
+                prompt TEXT NOT NULL,
+                copy_index INTEGER NOT NULL,
+                model_version TEXT NOT NULL,
+                size TEXT NOT NULL,
+                quality TEXT NOT NULL,
+                image_path TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            )""")
+        # Where each cached image was linked into other datasets, so a rerun into the same dataset doesn't link it again
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS links (
+                cache_key TEXT NOT NULL,
+                dataset_directory TEXT NOT NULL,
+                image_path TEXT NOT NULL,
+                PRIMARY KEY (cache_key, dataset_directory)
+            )""")
+        self.connection.commit()
+
+    # Function to find a cached image, entries whose file has been removed count as misses
+    def lookup(self, cache_key):
+        row = self.connection.execute("SELECT image_path FROM images WHERE cache_key = ?", (cache_key,)).fetchone()
+        if row is None or not os.path.exists(row[0]):
+            return None
+        self.connection.execute("UPDATE images SET last_used_at = ? WHERE cache_key = ?", (time.time(), cache_key))
+        return row[0]
+
+    # Function to add a freshly generated image to the cache
+    def store(self, cache_key, prompt, copy_index, model_version, size, quality, image_path):
+        now = time.time()
+        self.connection.execute("""
+            INSERT OR REPLACE INTO images (cache_key, prompt, copy_index, model_version, size, quality, image_path, created_at, last_used_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (cache_key, prompt, copy_index, model_version, size, quality, os.path.abspath(image_path), now, now))
+        self.connection.commit()
+
+    # Function to find the copy of a cached image already linked into a dataset folder, links whose file has been removed count as misses
+    def lookup_link(self, cache_key, dataset_directory):
+        row = self.connection.execute("SELECT image_path FROM links WHERE cache_key = ? AND dataset_directory = ?",
+                                      (cache_key, os.path.abspath(dataset_directory))).fetchone()
+        if row is None or not os.path.exists(row[0]):
+            return None
+        return row[0]
+
+    # Function to record that a cached image was linked into a dataset folder
+    def store_link(self, cache_key, dataset_directory, image_path):
+        self.connection.execute("INSERT OR REPLACE INTO links (cache_key, dataset_directory, image_path) VALUES (?, ?, ?)",
+                                (cache_key, os.path.abspath(dataset_directory), os.path.abspath(image_path)))
+        self.connection.commit()
+
+    # Function to drop entries whose image is gone, and optionally the ones not used for a number of days
+    def prune(self, max_age_days=None, delete_files=False):
+        cutoff = time.time() - max_age_days * 86400 if max_age_days is not None else None
+        removed = []
+        for cache_key, image_path, last_used_at in self.connection.execute("SELECT cache_key, image_path, last_used_at FROM images").fetchall():
+            expired = cutoff is not None and last_used_at < cutoff
+            if os.path.exists(image_path) and not expired:
+                continue
+            if expired and delete_files and os.path.exists(image_path):
+                os.remove(image_path)
+            removed.append((cache_key,))
+        self.connection.executemany("DELETE FROM images WHERE cache_key = ?", removed)
+        gone_links = [(cache_key, dataset_directory) for cache_key, dataset_directory, image_path
+                      in self.connection.execute("SELECT cache_key, dataset_directory, image_path FROM links").fetchall() if not os.path.exists(image_path)]
+        self.connection.executemany("DELETE FROM links WHERE cache_key = ? AND dataset_directory = ?", gone_links)
+        self.connection.executemany("DELETE FROM links WHERE cache_key = ?", removed)
+        self.connection.commit()
+        return len(removed)
+
+    # Function to count the entries in the cache
+    def count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the generated image cache.")
+    parser.add_argument('cache_file', help="Path to the cache index (the 'cache' setting)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('stats', help="Print the number of cached images")
+    prune_parser = subparsers.add_parser('prune', help="Remove entries whose image is gone, or that are older than --older-than days")
+    prune_parser.add_argument('--older-than', type=float, default=None, help="Also remove entries not used for this many days")
+    prune_parser.add_argument('--delete-files', action='store_true', help="Delete the image files of the entries removed by --older-than")
+    args = parser.parse_args(argv)
+
+    cache = ImageCache(args.cache_file)
+    if args.command == 'prune':
+        removed = cache.prune(args.older_than, args.delete_files)
+        print(f"Removed {removed} entries, {cache.count()} left.")
+    else:
+        print(f"{cache.count()} cached images.")
+    cache.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1427 @@
+import time
+startup_started = time.perf_counter()  # Taken before the other imports so their cost is part of the startup report
+import re
+import os
+import hashlib
+import base64
+import shutil
+import threading
+import queue
+import random
+import asyncio
+from importlib import metadata
+from itertools import product, chain
+from email.utils import parsedate_to_datetime
+from configparser import ConfigParser
+from datetime import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from DallEJournal import JobJournal, make_job_id
+from DallECache import ImageCache, make_cache_key
+from DallEManifest import get_manifest_writer, flush_manifests
+from DallEMetrics import metrics, start_metrics_export, finish_metrics_export
+from DallEPostprocess import start_postprocessor
+
+logger = logging.getLogger(__name__)
+
+# Heavy API modules, only imported once a generation actually starts
+openai = None
+requests = None
+
+# Function to import the API modules on first use
+def load_api_modules():
+    global openai, requests
+    if openai is None:
+        import requests as requests_module
+        import openai as openai_module
+        requests = requests_module
+        openai = openai_module
+
+# Startup phases and when they finished, reported once the program is ready
+startup_phases = []
+
+# Function to record that a startup phase has finished
+def mark_startup_phase(name):
+    startup_phases.append((name, time.perf_counter()))
+
+# Function to log how long each startup phase took
+def report_startup():
+    previous = startup_started
+    parts = []
+    for name, finished in startup_phases:
+        parts.append(f"{name} {(finished - previous) * 1000:.0f}ms")
+        previous = finished
+    logger.info("Startup took %.0fms (%s).", (previous - startup_started) * 1000, ', '.join(parts))
+
+mark_startup_phase('core imports')
+
+# Function to turn a version string into a comparable tuple, e.g. '1.12.0' -> (1, 12, 0)
+def parse_version(version):
+    return tuple(int(part) for part in re.findall(r'\d+', version)[:3])
+
+# Function to check the version of the openai package
+def check_openai_version(required_version='1.2.0'):  # Ensure this matches the versioning style of the package
+    # Read the installed version from the package metadata, without importing openai itself
+    try:
+        actual_version = metadata.version("openai")
+    except metadata.PackageNotFoundError:
+        raise ImportError(f"The openai package is not installed, version {required_version} or higher is required.")
+    if parse_version(actual_version) < parse_version(required_version):
+        raise ImportError(f"Your openai package version is {actual_version}, but version {required_version} or higher is required.")
+    else:
+        logger.info("openai package version is %s.", actual_version)
+
+# Function to read the [openai] key and where it came from, OPENAI_API_KEY only fills in when settings.ini has no key
+def read_api_key(config):
+    api_key = config.get('openai', 'api_key', fallback='')
+    if api_key:
+        return api_key, 'settings.ini'
+    return os.environ.get('OPENAI_API_KEY', ''), 'environment'
+
+# Function to read the API keys: the [openai] key, plus one [openai.<name>] section per extra key or organization
+def load_api_keys(config):
+    api_key, _ = read_api_key(config)
+    extra_sections = [section for section in config.sections() if section.startswith('openai.')]
+    keys = []
+    if api_key or not extra_sections:
+        keys.append({'name': 'default', 'api_key': api_key, 'organization': config.get('openai', 'organization', fallback=''), 'images_per_minute': None})
+    for section in extra_sections:
+        keys.append({
+            'name': section[len('openai.'):],
+            'api_key': config.get(section, 'api_key', fallback=''),
+            'organization': config.get(section, 'organization', fallback=''),
+            'images_per_minute': config.getint(section, 'images_per_minute', fallback=None),  # None uses the [defaults] limit
+        })
+    return keys
+
+# Function to load settings from the settings.ini file
+def load_settings(path='settings.ini'):
+    config = ConfigParser()
+    config.read(path)
+    if not config.has_section('defaults'):
+        config.add_section('defaults')
+    api_key, api_key_source = read_api_key(config)
+    return {
+        'api_key': api_key,
+        'api_key_source': api_key_source,  # Only a key read from settings.ini is ever written back to it
+        'api_keys': load_api_keys(config),
+        'model_version': config['defaults'].get('model_version', 'DALLE3'),
+        'model_mode': config['defaults'].get('model_mode', 'standard'),
+        'size': config['defaults'].get('size', '1024x1024'),
+        'generate_caption': config['defaults'].getboolean('generate_caption', True),
+        'generate_log': config['defaults'].getboolean('generate_log', True),
+        'conceptify': config['defaults'].getboolean('conceptify', False),
+        'dataset': config['defaults'].get('dataset', ''),
+        'quantity': config['defaults'].getint('quantity', 1),
+        'concurrency': config['defaults'].getint('concurrency', 4),
+        'images_per_minute': config['defaults'].getint('images_per_minute', 5),
+        'max_retries': config['defaults'].getint('max_retries', 5),
+        'download_retries': config['defaults'].getint('download_retries', 3),
+        'download_hedge': config['defaults'].getboolean('download_hedge', False),
+        'adaptive_concurrency': config['defaults'].getboolean('adaptive_concurrency', False),
+        'response_format': config['defaults'].get('response_format', 'url'),
+        'journal': config['defaults'].get('journal', ''),
+        'cache': config['defaults'].get('cache', ''),
+        'engine': config['defaults'].get('engine', 'threads'),
+        'manifest': config['defaults'].getboolean('manifest', False),
+        'shard_depth': config['defaults'].getint('shard_depth', 0),
+        'log_level': config['defaults'].get('log_level', 'INFO'),
+        'log_format': config['defaults'].get('log_format', 'text'),
+        'metrics_json': config['defaults'].get('metrics_json', ''),
+        'prometheus_file': config['defaults'].get('prometheus_file', ''),
+        'prometheus_port': config['defaults'].getint('prometheus_port', 0),
+        'prometheus_host': config['defaults'].get('prometheus_host', '127.0.0.1'),
+        'postprocess_format': config['defaults'].get('postprocess_format', ''),
+        'postprocess_quality': config['defaults'].getint('postprocess_quality', 90),
+        'postprocess_sizes': config['defaults'].get('postprocess_sizes', ''),
+        'postprocess_thumbnail': config['defaults'].getint('postprocess_thumbnail', 0),
+        'postprocess_workers': config['defaults'].getint('postprocess_workers', 0),
+        'prompt': config['defaults'].get('prompt', '')
+    }
+
+# Load settings
+settings = load_settings()
+mark_startup_phase('settings')
+
+# Call the version check function
+check_openai_version()
+mark_startup_phase('version check')
+
+# Model names used by the API for each model version
+MODEL_NAMES = {
+    'DALLE2': 'dall-e-2',
+    'DALLE3': 'dall-e-3',
+}
+
+# Largest number of images one request can ask for, DALL·E 3 only accepts n=1
+MAX_IMAGES_PER_REQUEST = {
+    'DALLE2': 10,
+    'DALLE3': 1,
+}
+
+# Token bucket that paces API requests to the account's images-per-minute limit
+class TokenBucket(object):
+    def __init__(self, rate_per_minute, capacity=1):
+        self.rate = rate_per_minute / 60.0  # Tokens added per second, 0 means unlimited
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.last_refill = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def reserve(self, amount=1):
+        # Take the tokens if they are available, otherwise return how long to wait before trying again
+        if self.rate <= 0:
+            return max(0.0, self.blocked_until - time.monotonic())
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            if now >= self.blocked_until and self.tokens >= min(amount, self.capacity):
+                # Requests larger than the bucket go into debt instead of waiting forever
+                self.tokens -= amount
+                return 0
+            return max(self.blocked_until - now, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    def wait_time(self, amount=1):
+        # How long a reserve would have to wait right now, without taking any tokens
+        if self.rate <= 0:
+            return max(0.0, self.blocked_until - time.monotonic())
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            return max(0.0, self.blocked_until - now, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    def acquire(self, amount=1):
+        wait = self.reserve(amount)
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.reserve(amount)
+
+    async def acquire_async(self, amount=1):
+        wait = self.reserve(amount)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self.reserve(amount)
+
+    def pause(self, seconds):
+        # Hold back every worker, e.g. while the API asks us to back off
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+# 429s in a row after which a key is benched, and how long the first bench lasts (doubling each time, up to the cap).
+# A key that is the only usable one is only held back for its Retry-After or a short backoff, never for the long bench
+BENCH_AFTER_RATE_LIMITS = 3
+BENCH_SECONDS = 60.0
+MAX_BENCH_SECONDS = 900.0
+SHORT_BENCH_SECONDS = 0.5
+MAX_SHORT_BENCH_SECONDS = 8.0
+
+# One API key (or organization) of the pool, with its own rate budget, in-flight counter and health
+class ApiKey(object):
+    def __init__(self, name, api_key, organization=None, images_per_minute=0):
+        self.name = name
+        self.api_key = api_key
+        self.organization = organization or None
+        self.rate_limiter = TokenBucket(images_per_minute)
+        self.in_flight = 0
+        self.rate_limits_in_row = 0
+        self.last_rate_limited = 0.0  # When the last counted 429 came back, 429s of requests sent before it belong to the same burst
+        self.times_benched = 0
+        self.benched_until = 0.0
+        self.disabled = False  # Set once the API rejects the key, for the rest of the process
+        self.client = None
+
+    def usable(self, now):
+        return not self.disabled and now >= self.benched_until
+
+# Pool of API keys: each request goes to the healthy key that can send soonest, then to the one with the fewest requests in flight
+class KeyPool(object):
+    def __init__(self, keys):
+        self.keys = keys
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    # Function to reserve a request on the best key, returns (key, 0) or (None, how long to wait before trying again)
+    def try_acquire(self, amount=1):
+        with self.lock:
+            now = time.monotonic()
+            candidates = [key for key in self.keys if key.usable(now)]
+            if not candidates:
+                if all(key.disabled for key in self.keys):
+                    raise RuntimeError("Every API key was rejected by the API, check the keys in settings.ini.")
+                return None, min(key.benched_until for key in self.keys if not key.disabled) - now
+            key = min(candidates, key=lambda candidate: (candidate.rate_limiter.wait_time(amount), candidate.in_flight))
+            wait = key.rate_limiter.reserve(amount)
+            if wait > 0:
+                return None, wait
+            key.in_flight += 1
+            return key, 0
+
+    def acquire(self, amount=1):
+        key, wait = self.try_acquire(amount)
+        while key is None:
+            time.sleep(wait)
+            key, wait = self.try_acquire(amount)
+        return key
+
+    async def acquire_async(self, amount=1):
+        key, wait = self.try_acquire(amount)
+        while key is None:
+            await asyncio.sleep(wait)
+            key, wait = self.try_acquire(amount)
+        return key
+
+    # Function to record how a request on a key went: keys are benched after repeated 429s and disabled once the API rejects them.
+    # started is when the request was sent, so a burst of concurrent 429s counts as one
+    def release(self, key, error=None, images=0, cost=0.0, started=None):
+        rate_limited = error is not None and isinstance(error, openai.RateLimitError)
+        metrics.add_key_counts(key.name, requests=1, images=images, spend=images * cost, rate_limited=int(rate_limited),
+                               errors=int(error is not None and not rate_limited))
+        with self.lock:
+            key.in_flight -= 1
+            if error is None:
+                key.rate_limits_in_row = 0
+                key.times_benched = 0
+            elif is_key_error(error):
+                if not key.disabled:
+                    logger.error("API key '%s' was rejected (%s), it won't be used again.", key.name, error.__class__.__name__)
+                key.disabled = True
+            elif rate_limited and (started is None or started >= key.last_rate_limited):
+                now = time.monotonic()
+                key.last_rate_limited = now
+                key.rate_limits_in_row += 1
+                if key.rate_limits_in_row >= BENCH_AFTER_RATE_LIMITS:
+                    # The long bench only pays off while another key can take over, otherwise it just idles below the quota
+                    retry_after = get_retry_after(error) or 0.0
+                    if any(other is not key and other.usable(now) for other in self.keys):
+                        seconds = max(retry_after, min(MAX_BENCH_SECONDS, BENCH_SECONDS * 2 ** key.times_benched))
+                    else:
+                        seconds = max(retry_after, min(MAX_SHORT_BENCH_SECONDS, SHORT_BENCH_SECONDS * 2 ** key.times_benched))
+                    key.benched_until = now + seconds
+                    key.times_benched += 1
+                    key.rate_limits_in_row = 0
+                    logger.warning("API key '%s' was rate limited %d times in a row, benched for %.1fs.", key.name, BENCH_AFTER_RATE_LIMITS, seconds)
+
+# Function to build the key pool from the settings, each key gets its own images-per-minute budget
+def build_key_pool(settings):
+    return KeyPool([ApiKey(key['name'], key['api_key'], key['organization'],
+                           key['images_per_minute'] if key['images_per_minute'] is not None else settings['images_per_minute'])
+                    for key in settings['api_keys']])
+
+# Shared scheduler for all image requests
+key_pool = build_key_pool(settings)
+
+# Tuning of the adaptive concurrency controller: how much a 429 or server error and a latency spike cut the limit,
+# how far over the typical latency a request has to be to count as a spike, and how quickly the typical latency follows new samples
+RATE_LIMIT_DECREASE = 0.5
+LATENCY_SPIKE_DECREASE = 0.8
+LATENCY_SPIKE_FACTOR = 2.0
+LATENCY_SMOOTHING = 0.2
+LATENCY_MIN_SAMPLES = 5
+
+# AIMD limit on the requests in flight for one model/size/quality combination: slow start doubles the limit every round of
+# healthy requests until the first cut, after that it grows by one per round, and 429s, server errors or latency spikes cut it
+class ConcurrencyController(object):
+    def __init__(self, name, max_limit, min_limit=1):
+        self.name = name
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(self.min_limit)
+        self.in_flight = 0
+        self.slow_start = True
+        self.typical_latency = None
+        self.latency_samples = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def current_limit(self):
+        return int(self.limit)
+
+    # Function to change the ceiling, e.g. to the concurrency of a new run, keeping what was learned so far
+    def set_max_limit(self, max_limit):
+        with self.condition:
+            self.max_limit = max(self.min_limit, max_limit)
+            self.limit = min(self.limit, self.max_limit)
+            self.condition.notify_all()
+
+    def try_acquire(self):
+        with self.condition:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        while not self.try_acquire():
+            await asyncio.sleep(0.05)
+
+    # Function to free a slot and adjust the limit from how the request went, a request that never reached the API passes neither
+    def release(self, latency=None, error=None):
+        with self.condition:
+            self.in_flight -= 1
+            old_limit = self.current_limit()
+            reason = None
+            if error is not None:
+                if isinstance(error, openai.RateLimitError) or is_retryable_error(error):
+                    reason = self.decrease(RATE_LIMIT_DECREASE, 'rate limited' if isinstance(error, openai.RateLimitError) else 'server error')
+            elif latency is not None:
+                if self.latency_samples >= LATENCY_MIN_SAMPLES and latency > LATENCY_SPIKE_FACTOR * self.typical_latency:
+                    reason = self.decrease(LATENCY_SPIKE_DECREASE, f"latency spike {latency:.2f}s")
+                else:
+                    self.typical_latency = latency if self.typical_latency is None else self.typical_latency + LATENCY_SMOOTHING * (latency - self.typical_latency)
+                    self.latency_samples += 1
+                    self.limit = min(self.max_limit, self.limit + (1.0 if self.slow_start else 1.0 / self.limit))
+                    reason = 'healthy'
+            new_limit = self.current_limit()
+            self.condition.notify_all()
+        if new_limit != old_limit:
+            logger.info("Concurrency for %s: %d -> %d requests in flight (%s).", self.name, old_limit, new_limit, reason,
+                        extra={'combination': self.name, 'limit': new_limit})
+            metrics.record_concurrency_limit(self.name, new_limit, reason)
+
+    # Cut at most once per typical latency, so the requests already in flight when the API pushed back don't cut again
+    def decrease(self, factor, reason):
+        now = time.monotonic()
+        if now - self.last_decrease < (self.typical_latency or 0):
+            return None
+        self.last_decrease = now
+        self.slow_start = False
+        self.limit = max(self.min_limit, self.limit * factor)
+        return reason
+
+# Controllers by (model, size, quality), kept for the whole process so later runs start from what earlier ones learned
+concurrency_controllers = {}
+concurrency_controllers_lock = threading.Lock()
+
+# Function to get the controller of a model/size/quality combination, None unless adaptive concurrency is on.
+# max_limit is the caller's own concurrency and sets the ceiling, without one a new controller is capped at the concurrency setting
+def get_concurrency_controller(model, size, quality, max_limit=None):
+    if not settings['adaptive_concurrency']:
+        return None
+    with concurrency_controllers_lock:
+        controller = concurrency_controllers.get((model, size, quality))
+        if controller is None:
+            controller = concurrency_controllers[(model, size, quality)] = ConcurrencyController(f"{model} {size} {quality}", max_limit or settings['concurrency'])
+        elif max_limit and max_limit != controller.max_limit:
+            controller.set_max_limit(max_limit)
+        elif metrics.has_concurrency_limit(controller.name):
+            # Only the first request of a run records the limit learned so far
+            return controller
+    metrics.record_concurrency_limit(controller.name, controller.current_limit(), 'start')
+    return controller
+
+# Shared API clients and HTTP session, created once so every worker reuses the same keep-alive connections
+client_lock = threading.Lock()
+http_session = None
+http_pool_size = None
+
+# Function to get the process-wide OpenAI client of an API key, the first key of the pool by default
+def get_openai_client(key=None):
+    key = key or key_pool.keys[0]
+    load_api_modules()
+    with client_lock:
+        if key.client is None:
+            # Retries are handled by our own scheduler; the default connection pool already allows 100 keep-alive connections
+            key.client = openai.OpenAI(api_key=key.api_key, organization=key.organization, max_retries=0)
+        return key.client
+
+# Function to get the process-wide download session, with a connection pool sized to the concurrency
+def get_http_session(pool_size=None):
+    global http_session, http_pool_size
+    load_api_modules()
+    with client_lock:
+        if http_session is None:
+            http_session = requests.Session()
+            pool_size = pool_size or settings['concurrency']
+        # Remounting throws away the pooled keep-alive connections, so only do it when the size changes
+        if pool_size and pool_size != http_pool_size:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            http_session.mount('https://', adapter)
+            http_session.mount('http://', adapter)
+            http_pool_size = pool_size
+        return http_session
+
+# Function to read the Retry-After delay (in seconds) from an API error, if the server sent one
+def get_retry_after(error):
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    retry_after_ms = response.headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000.0
+        except ValueError:
+            pass
+    retry_after = response.headers.get('retry-after')
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    # Otherwise the header is an HTTP date
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(tz=retry_at.tzinfo)).total_seconds())
+
+# Function to calculate a jittered exponential backoff delay
+def get_backoff_delay(attempt, base=1.0, cap=60.0):
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+# Function to decide whether an API error is worth retrying
+def is_retryable_error(error):
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500
+    return False
+
+# Function to decide whether an API error means the key itself was rejected
+def is_key_error(error):
+    return isinstance(error, (openai.AuthenticationError, openai.PermissionDeniedError))
+
+# Function to get how long to wait before retrying a failed API call on a key, or None if it should not be retried
+def get_retry_delay(error, attempt, key=None):
+    if isinstance(error, openai.RateLimitError):
+        metrics.increment('rate_limited')
+    if attempt >= settings['max_retries']:
+        return None
+    # With more than one key, the retry can go to another key straight away
+    other_keys = key is not None and len(key_pool) > 1
+    if is_key_error(error) and other_keys:
+        return 0.0
+    if not is_retryable_error(error):
+        return None
+    retry_after = get_retry_after(error)
+    delay = retry_after if retry_after is not None else get_backoff_delay(attempt)
+    if isinstance(error, openai.RateLimitError):
+        # A 429 applies to the whole account, so hold back every worker using that key
+        (key.rate_limiter if key is not None else key_pool.keys[0].rate_limiter).pause(delay)
+        if other_keys:
+            return 0.0
+    return delay
+
+# Pricing information
+PRICING = {
+    'DALLE3': {
+        '1024×1024': 0.040,
+        '1024×1792': 0.080,
+        '1792×1024': 0.080,
+    },
+    'DALLE3HD': {
+        '1024×1024': 0.080,
+        '1024×1792': 0.120,
+        '1792×1024': 0.120,
+    },
+    'DALLE2': {
+        '1024×1024': 0.020,
+        '512×512': 0.018,
+        '256×256': 0.016,
+    }
+}
+
+# Function to calculate the cost of generating images
+def calculate_cost(model_version, resolution, quality, quantity):
+    # Convert the resolution format for correct dictionary lookup
+    resolution_key = resolution.replace('x', '×')
+
+    # Determine the pricing category based on quality and model version
+    pricing_category = model_version
+    if quality == 'hd' and model_version == "DALLE3":
+        pricing_category = 'DALLE3HD'
+
+    # Look up the price based on resolution and pricing category
+    price_per_image = PRICING.get(pricing_category, {}).get(resolution_key, 0.0)
+    total_cost = price_per_image * quantity
+    return total_cost
+
+# Function to get the price of one image from the model name sent to the API
+def get_image_cost(model, size, quality):
+    model_version = next((version for version, name in MODEL_NAMES.items() if name == model), model)
+    return calculate_cost(model_version, size, quality, 1)
+
+# Pattern that pulls the concept tag out of a prompt when conceptify is enabled
+CONCEPT_PATTERN = re.compile(r"\[(.*?)\](.*)", re.VERBOSE)
+
+# Function to split a prompt into its concept and the rest of the prompt, (None, prompt) if there is no tag
+def split_concept(prompt):
+    match = CONCEPT_PATTERN.search(prompt)
+    if match:
+        return match.group(1), match.group(2).strip()
+    return None, prompt
+
+# Function to check that a piece of a template only has simple one-line [tags], so it can be precompiled
+def is_simple_segment(text):
+    return '\n' not in text and not re.search(r'[\[\]]', re.sub(r'\[[^\[\]\n]*\]', '', text))
+
+# Function to find the first concept tag in a piece of text, as (concept, end of the tag) or None
+def find_tag(text):
+    match = CONCEPT_PATTERN.search(text)
+    return (match.group(1), match.end(1) + 1) if match else None
+
+# Prompt template parsed once into literal text and variable slots, rendered with a single str.format per prompt
+class PromptTemplate(object):
+    def __init__(self, base_prompt, variables):
+        self.base_prompt = base_prompt
+        self.names = list(variables)
+        self.values = [variables[name] for name in self.names]
+
+        # Split the template on every [VARIABLE]; literals stay strings, slots become the variable's index
+        tags = [f'[{name}]' for name in self.names]
+        slot_of = {tag: index for index, tag in enumerate(tags)}
+        pattern = '(' + '|'.join(re.escape(tag) for tag in sorted(tags, key=len, reverse=True)) + ')'
+        pieces = re.split(pattern, base_prompt) if tags else [base_prompt]
+        self.segments = [slot_of[piece] if index % 2 else piece for index, piece in enumerate(pieces) if index % 2 or piece]
+        self.format_string = ''.join(segment.replace('{', '{{').replace('}', '}}') if isinstance(segment, str) else '{%d}' % segment
+                                     for segment in self.segments)
+
+        # The precompiled path must give exactly what the str.replace chain and concept regex give, otherwise fall back to them
+        self.compiled = (all(is_simple_segment(segment) for segment in self.segments if isinstance(segment, str))
+                         and all(is_simple_segment(value) and not any(tag in value for tag in tags) for values in self.values for value in values))
+
+        # Resolve the concept tag of every variable value once, at parse time, as (concept, end of the tag) or None
+        self.value_tags = [dict((value, find_tag(value)) for value in values) for values in self.values]
+
+        # Segments to scan for the concept, up to the first literal that has a tag itself: (slot or None, length, tag)
+        self.concept_scan = []
+        for segment in self.segments:
+            if isinstance(segment, str):
+                self.concept_scan.append((None, len(segment), find_tag(segment)))
+                if self.concept_scan[-1][2]:
+                    break
+            else:
+                self.concept_scan.append((segment, 0, None))
+
+    # Function to count the prompts without expanding them
+    def count(self):
+        total = 1
+        for values in self.values:
+            total *= len(values)
+        return total
+
+    # Function to render one combination of variable values, the slow path for templates that can't be precompiled
+    def render_replace(self, combination):
+        permuted_prompt = self.base_prompt
+        for var, val in zip(self.names, combination):
+            permuted_prompt = permuted_prompt.replace(f'[{var}]', val)
+        return permuted_prompt
+
+    # Function to find the index of each variable's value at a position of the expansion, without expanding it
+    def positions_at(self, index):
+        positions = []
+        for values in reversed(self.values):
+            index, position = divmod(index, len(values))
+            positions.append(position)
+        return positions[::-1]
+
+    # Function to find the combination of variable values at a position of the expansion, without expanding it
+    def combination_at(self, index):
+        return [values[position] for values, position in zip(self.values, self.positions_at(index))]
+
+    # Function to lazily yield every combination from a position on, as one product per variable instead of skipping to it
+    def combinations(self, start=0):
+        if not start:
+            return product(*self.values)
+        if start >= self.count():
+            return iter(())
+        positions = self.positions_at(start)
+        # The rest of the expansion is the combinations sharing the longest prefix with the start one, then each shorter prefix
+        parts = []
+        last = len(self.values) - 1
+        for level in range(last, -1, -1):
+            fixed = [[values[position]] for values, position in zip(self.values[:level], positions[:level])]
+            first = positions[level] if level == last else positions[level] + 1
+            parts.append(product(*fixed, self.values[level][first:], *self.values[level + 1:]))
+        return chain.from_iterable(parts)
+
+    # Function to render the prompt at a position of the expansion
+    def prompt_at(self, index):
+        combination = self.combination_at(index)
+        return self.format_string.format(*combination) if self.compiled else self.render_replace(combination)
+
+    # Function to lazily yield every prompt the template expands to, optionally starting at a position
+    def prompts(self, start=0):
+        combinations = self.combinations(start)
+        if not self.compiled:
+            for combination in combinations:
+                yield self.render_replace(combination)
+            return
+        render = self.format_string.format
+        for combination in combinations:
+            yield render(*combination)
+
+    # Function to lazily yield (prompt, concept_parts) for every prompt, concept_parts is (concept, prompt without concept) or None
+    def jobs(self, conceptify):
+        if not conceptify:
+            for prompt in self.prompts():
+                yield prompt, None
+            return
+        if not self.compiled:
+            for prompt in self.prompts():
+                yield prompt, split_concept(prompt)
+            return
+        render = self.format_string.format
+        for combination in product(*self.values):
+            prompt = render(*combination)
+            yield prompt, self.find_concept(prompt, combination)
+
+    # Function to find the concept of a rendered prompt from the tags resolved at parse time
+    def find_concept(self, prompt, combination):
+        offset = 0
+        for slot, length, tag in self.concept_scan:
+            if slot is not None:
+                value = combination[slot]
+                tag = self.value_tags[slot][value]
+                length = len(value)
+            if tag:
+                # The rest of the prompt starts right after the tag's closing bracket
+                return tag[0], prompt[offset + tag[1]:].strip()
+            offset += length
+        return None, prompt
+
+# Function to count how many prompts a template expands to, without expanding it
+def count_prompts(variables):
+    total = 1
+    for values in variables.values():
+        total *= len(values)
+    return total
+
+# Function to lazily expand a prompt template into every permutation of its variables
+def expand_prompts(base_prompt, variables):
+    return PromptTemplate(base_prompt, variables).prompts()
+
+# Function to split a prompt's copies into the fewest requests the model allows, each batch is one API call
+def batch_copies(copies, model_version):
+    batch_size = MAX_IMAGES_PER_REQUEST.get(model_version, 1)
+    return [copies[start:start + batch_size] for start in range(0, len(copies), batch_size)]
+
+# Function to hand the images of a response to the copies that asked for them, in order; any extra images go to the last copy
+def assign_images(images, copy_count):
+    assigned = [[] for _ in range(copy_count)]
+    for index, image in enumerate(images):
+        assigned[min(index, copy_count - 1)].append(image)
+    return assigned
+
+# Function to send a progress snapshot to the caller's progress callback, if there is one
+def send_progress(progress, state, total, completed, failed, skipped, reused, in_flight):
+    if progress is None:
+        return
+    progress({
+        'state': state,
+        'total': total,
+        'completed': completed,
+        'failed': failed,
+        'skipped': skipped,
+        'reused': reused,
+        'in_flight': in_flight,
+        'images': metrics.images,
+        'spend': metrics.spend,
+        'images_per_minute': metrics.images_per_minute(),
+    })
+
+# Function to generate images in parallel, streaming the prompt x copy jobs from the template.
+# progress is called with a snapshot of the counts whenever a job finishes; setting stop_event lets the
+# jobs in flight finish and cancels the queued ones, which stay queued in the journal for a later run
+def run_generation(base_prompt, variables, quantity, size, quality, model_version, generate_log, generate_caption, conceptify, dataset, concurrency,
+                   journal_path=None, cache_path=None, engine=None, progress=None, stop_event=None):
+    # The asyncio engine runs the same job on one event loop instead of a thread per request
+    if (engine or settings['engine']) == 'asyncio':
+        from DallEAsync import run_async_generation
+        return run_async_generation(base_prompt, variables, quantity, size, quality, model_version, generate_log, generate_caption,
+                                    conceptify, dataset, concurrency, journal_path=journal_path, cache_path=cache_path,
+                                    progress=progress, stop_event=stop_event)
+
+    concurrency = max(1, concurrency)
+    load_api_modules()
+    total_jobs = count_prompts(variables) * quantity if base_prompt else 0
+
+    # Open the job journal, if any, and skip the jobs an earlier run already wrote
+    journal = JobJournal(journal_path) if journal_path else None
+    written_job_ids = journal.completed_job_ids() if journal else set()
+    if written_job_ids:
+        logger.info("Resuming from journal %s: %d jobs already written.", journal_path, len(written_job_ids))
+
+    # Open the image cache, if any, so unchanged prompt and parameter combinations reuse their images
+    cache = ImageCache(cache_path) if cache_path else None
+
+    # Stream the prompts straight from the template expansion, each prompt's copies are batched into as few requests as the model allows
+    prompt_jobs = PromptTemplate(base_prompt, variables).jobs(conceptify)
+    logger.info("Generating %d images with up to %d requests in flight.", total_jobs, concurrency)
+
+    # Size the shared download pool to the number of workers and start publishing fresh metrics
+    clear_created_directories()
+    get_http_session(concurrency)
+    exporter = start_metrics_export(settings)
+
+    # With adaptive concurrency the pool size is only the ceiling, the controller decides how many requests are in flight
+    controller = get_concurrency_controller(MODEL_NAMES.get(model_version, 'dall-e-3'), size, quality, concurrency)
+    if controller:
+        logger.info("Adaptive concurrency for %s starts at %d requests in flight.", controller.name, controller.current_limit())
+
+    # Start the post-processing process pool, if converting, resizing or thumbnails are enabled
+    postprocessor = start_postprocessor(settings)
+
+    # Drain the job stream with a bounded pool of workers, only keeping a small window of jobs submitted
+    failed_jobs = []
+    counts = {'completed': 0, 'skipped': 0, 'reused': 0}
+    futures = {}
+    stopping = lambda: stop_event is not None and stop_event.is_set()
+
+    def report():
+        finished = counts['skipped'] + counts['reused'] + counts['completed'] + len(failed_jobs)
+        logger.info("Progress: %d/%d jobs finished, %d failed.", finished, total_jobs, len(failed_jobs))
+        in_flight = sum(len(batch[1]) for batch in futures.values())
+        send_progress(progress, 'running', total_jobs, counts['completed'], len(failed_jobs), counts['skipped'], counts['reused'], in_flight)
+
+    # Function to collect finished jobs until no more than `limit` are left, cancelling the queued ones once a stop is requested
+    def wait_for_jobs(limit):
+        while len(futures) > limit:
+            if stopping():
+                for future in [future for future in futures if future.cancel()]:
+                    del futures[future]
+                if not futures:
+                    break
+            done, _ = wait(futures, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in done:
+                counts['completed'] += collect_job_result(future, futures.pop(future), failed_jobs, journal, cache, (model_version, size, quality), postprocessor)
+                report()
+
+    send_progress(progress, 'running', total_jobs, 0, 0, 0, 0, 0)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for prompt, concept_parts in prompt_jobs:
+            if stopping():
+                break
+            # Leave out the copies the journal or the cache already have
+            copies = []
+            for copy_index in range(quantity):
+                job_id = make_job_id(prompt, copy_index, model_version, size, quality, dataset)
+                if job_id in written_job_ids:
+                    counts['skipped'] += 1
+                    continue
+                cache_key = make_cache_key(prompt, copy_index, model_version, size, quality) if cache else None
+                cached_path = cache.lookup(cache_key) if cache else None
+                if cached_path:
+                    # A dataset an earlier run already linked this image into keeps that copy
+                    dataset_directory = get_dataset_directory(dataset)
+                    linked_path = cache.lookup_link(cache_key, dataset_directory)
+                    image_path = reuse_cached_image(cached_path, prompt, copy_index, job_id, model_version, size, quality, generate_log, generate_caption,
+                                                    conceptify, dataset, concept_parts, journal, linked_path)
+                    if image_path:
+                        cache.store_link(cache_key, dataset_directory, image_path)
+                        counts['reused'] += 1
+                        if postprocessor and image_path not in (cached_path, linked_path):
+                            postprocessor.submit(image_path)
+                        continue
+                copies.append((copy_index, job_id, cache_key))
+            for batch in batch_copies(copies, model_version):
+                wait_for_jobs(concurrency * 2 - 1)
+                if stopping():
+                    break
+                if journal:
+                    for copy_index, job_id, _ in batch:
+                        journal.record(job_id, 'queued', prompt=prompt, copy_index=copy_index)
+                job_ids = [job_id for _, job_id, _ in batch]
+                future = executor.submit(create_images_thread, prompt, len(batch), size, quality, model_version, generate_log, generate_caption, conceptify, dataset, journal, job_ids, concept_parts,
+                                         concurrency)
+                futures[future] = (prompt, batch)
+
+        # Wait for the remaining jobs
+        wait_for_jobs(0)
+
+    # Make sure every state change and manifest record is on disk before reporting
+    wait_for_hedged_downloads()
+    flush_manifests()
+    if postprocessor:
+        postprocessor.close()
+    if journal:
+        journal.close()
+    if counts['skipped']:
+        logger.info("%d jobs were skipped because the journal already had them written.", counts['skipped'])
+    if cache:
+        cache.close()
+    if counts['reused']:
+        logger.info("%d jobs reused cached images instead of calling the API.", counts['reused'])
+
+    # Everything that did not finish was cancelled by a stop request
+    cancelled = total_jobs - counts['skipped'] - counts['reused'] - counts['completed'] - len(failed_jobs)
+    if cancelled:
+        logger.warning("Stopped: %d queued jobs were cancelled.", cancelled)
+
+    # Report the jobs that did not produce an image
+    if failed_jobs:
+        logger.warning("%d of %d jobs failed:", len(failed_jobs), total_jobs)
+        for prompt, copy_index in failed_jobs:
+            logger.warning("  - copy %d of prompt: '%s'", copy_index + 1, prompt)
+
+    # Report the latencies, throughput and spend of this run
+    finish_metrics_export(exporter, settings)
+    send_progress(progress, 'stopped' if cancelled else 'done', total_jobs, counts['completed'], len(failed_jobs), counts['skipped'], counts['reused'], 0)
+
+    logger.info("All images have been processed.")
+    return counts['completed'], failed_jobs
+
+# Helper function to record the outcome of a finished request, returns how many of its copies produced an image
+def collect_job_result(future, job, failed_jobs, journal=None, cache=None, request_params=(), postprocessor=None):
+    prompt, batch = job
+    try:
+        saved_paths = future.result()
+    except Exception as e:
+        logger.error("Job failed for prompt: '%s' (copies %s): %s", prompt, ', '.join(str(copy_index + 1) for copy_index, _, _ in batch), e, exc_info=True)
+        saved_paths = []
+    completed = 0
+    for position, (copy_index, job_id, cache_key) in enumerate(batch):
+        copy_paths = saved_paths[position] if position < len(saved_paths) else []
+        if copy_paths:
+            if cache:
+                cache.store(cache_key, prompt, copy_index, *request_params, copy_paths[0])
+            if postprocessor:
+                for image_path in copy_paths:
+                    postprocessor.submit(image_path)
+            completed += 1
+            continue
+        if journal:
+            journal.record(job_id, 'failed')
+        metrics.increment('jobs_failed')
+        failed_jobs.append((prompt, copy_index))
+    return completed
+
+# Helper function to put a cached image into this run's output like a generated one: linked into the layout with its caption, log and
+# manifest record, and journaled as written. linked_path is the copy an earlier run already linked into this dataset, which is kept as it is.
+# Returns the path, or None if it could not be linked and has to be generated after all
+def reuse_cached_image(cached_path, prompt, copy_index, job_id, model_version, size, quality, generate_log, generate_caption, conceptify, dataset,
+                       concept_parts=None, journal=None, linked_path=None):
+    image_path = linked_path
+    if not image_path:
+        concept, _ = extract_concept(prompt, conceptify, concept_parts)
+        metadata = dict(build_image_metadata(model_version, size, quality, 0), cost=0.0, reused_from=cached_path)
+        image_path = save_image_details_and_download(None, prompt, generate_log, generate_caption, concept, dataset, metadata=metadata, image_file=cached_path)
+    if not image_path:
+        return None
+    metrics.increment('reused')
+    if journal:
+        journal.record(job_id, 'written', prompt=prompt, copy_index=copy_index, image_path=image_path)
+    logger.info("Reusing cached image for prompt: '%s' (copy %d): %s", prompt, copy_index + 1, image_path)
+    return image_path
+
+# Helper function to create the images of one request, n copies of a prompt. Returns the paths saved for each copy, in order
+def create_images_thread(prompt, n, size, quality, model_version, generate_log, generate_caption, conceptify, dataset, journal=None, job_ids=(), concept_parts=None, concurrency=None):
+    saved_paths = [[] for _ in range(n)]
+    if journal:
+        for job_id in job_ids:
+            journal.record(job_id, 'requested')
+
+    # Call create_image with all the required parameters, including conceptify
+    generate_start = time.monotonic()
+    images, concept = create_image(prompt, n=n, model=MODEL_NAMES.get(model_version, 'dall-e-3'), size=size, quality=quality, conceptify=conceptify, concept_parts=concept_parts,
+                                   concurrency=concurrency)
+    metadata = build_image_metadata(model_version, size, quality, time.monotonic() - generate_start)
+    
+    if images:  # Check if the images list is not empty
+        # Every image in the response is saved, the n-th image belongs to the n-th copy
+        for position, copy_images in enumerate(assign_images(images, n)):
+            job_id = job_ids[position] if position < len(job_ids) else None
+            for image in copy_images:
+                # Pass the actual boolean values and the concept to the function
+                image_path = save_image_details_and_download(image.url, prompt, generate_log, generate_caption, concept, dataset, image_b64=image.b64_json, metadata=metadata)
+                if image_path:
+                    saved_paths[position].append(image_path)
+                    if journal and job_id:
+                        journal.record(job_id, 'downloaded', image_path=image_path)
+                    logger.info("Generated image for prompt: '%s' saved to: %s", prompt, image_path)
+            # The job is only written once every image and its sidecar files are on disk
+            if journal and job_id and saved_paths[position]:
+                journal.record(job_id, 'written')
+    else:
+        logger.warning("No images were generated for prompt: '%s'. Please check for errors.", prompt)
+
+    # Return the paths of the images that were saved
+    return saved_paths
+
+    
+# Function to split the concept tag off the front of a prompt, if conceptify is enabled
+def extract_concept(prompt, conceptify, concept_parts=None):
+    concept = None  # Initialize concept as None
+    if conceptify:
+        # Use the concept resolved when the template was parsed, or find it in the prompt
+        concept, rest = concept_parts if concept_parts is not None else split_concept(prompt)
+        if concept is not None:
+            prompt = rest  # The rest of the prompt without the concept
+            logger.debug("Concept identified: %s", concept)
+            logger.debug("Prompt after processing: %s", prompt)
+        else:
+            logger.debug("No concept identified: Regex did not match. Prompt was: %r", prompt)
+    else:
+        logger.debug("Conceptify is disabled.")
+    return concept, prompt
+
+# Function to prepare the parameters for the API call
+def build_image_params(prompt, n, model, size, quality):
+    return {
+        "prompt": prompt,
+        "n": n,
+        "size": size,
+        "model": model,
+        "quality": quality,
+        "response_format": settings['response_format']
+    }
+
+# Function to log the API response at debug level, without flooding the console with base64 image data
+def log_api_response(response):
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    if settings['response_format'] == 'b64_json':
+        logger.debug("API Response: %d image(s) returned inline", len(response.data))
+    else:
+        logger.debug("API Response: %s", response)
+
+# Function to create an image with DALL·E
+def create_image(prompt, n=1, model="dall-e-3", size="1024x1024", quality="standard", conceptify=False, concept_parts=None, concurrency=None):
+    try:
+        logger.debug("Prompt before processing: %s", prompt)
+        logger.debug("Size: %s", size)
+        logger.debug("Quality: %s", quality)
+
+        # Extract concept if conceptify is enabled
+        concept, prompt = extract_concept(prompt, conceptify, concept_parts)
+
+        # Prepare the parameters for the API call
+        params = build_image_params(prompt, n, model, size, quality)
+
+        # Log the parameters for debugging
+        logger.debug("Making API request with params: %s", params)
+
+        # Make an API call to OpenAI's Image creation endpoint on a healthy key, retrying rate limits and server errors.
+        # With adaptive concurrency every attempt also takes a slot from the controller of this model/size/quality, capped at the caller's concurrency
+        controller = get_concurrency_controller(model, size, quality, concurrency)
+        attempt = 0
+        while True:
+            if controller:
+                controller.acquire()
+            try:
+                key = key_pool.acquire(n)
+            except Exception:
+                if controller:
+                    controller.release()
+                raise
+            try:
+                request_start = time.monotonic()
+                metrics.increment('requests')
+                # Reuse the key's shared OpenAI client instance
+                response = get_openai_client(key).images.generate(**params)
+                latency = time.monotonic() - request_start
+                metrics.record('api', latency)
+                key_pool.release(key, images=len(response.data), cost=get_image_cost(model, size, quality), started=request_start)
+                if controller:
+                    controller.release(latency)
+                break
+            except Exception as e:
+                key_pool.release(key, e, started=request_start)
+                if controller:
+                    controller.release(error=e)
+                delay = get_retry_delay(e, attempt, key)
+                if delay is None:
+                    raise
+                attempt += 1
+                metrics.increment('retries')
+                logger.warning("Request failed (%s), retry %d/%d in %.1fs for prompt: '%s'", e.__class__.__name__, attempt, settings['max_retries'], delay, prompt)
+                time.sleep(delay)
+        log_api_response(response)
+
+        # Return both the images (URL or inline base64 data) and the concept
+        return response.data, concept
+
+    except Exception as e:
+        logger.error("An unexpected error occurred: %s", e, exc_info=True)
+
+    # This return should be outside the try...except block
+    return [], None  # Return an empty list and None for concept if an error occurred
+
+
+# Every PNG starts with this signature and ends with an IEND chunk
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_TRAILER = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+
+# HTTP statuses worth retrying a download for; anything else (e.g. 403 once a signed URL has expired) won't get better
+RETRYABLE_DOWNLOAD_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+# Raised when a download fails or the file that arrived is not a whole image.
+# restart means the bytes that arrived are wrong, so a retry must start over instead of resuming after them
+class DownloadError(Exception):
+    def __init__(self, message, retryable=True, restart=False):
+        super().__init__(message)
+        self.retryable = retryable
+        self.restart = restart
+
+# Function to check that downloaded bytes are a whole PNG: the signature, the length the server announced and the closing IEND chunk
+def check_png(head, tail, length, expected_length=None):
+    if expected_length is not None and length < expected_length:
+        raise DownloadError(f"incomplete download, got {length} of {expected_length} bytes")
+    if expected_length is not None and length > expected_length:
+        raise DownloadError(f"got {length} bytes, {expected_length} were expected", restart=True)
+    if not head.startswith(PNG_SIGNATURE):
+        raise DownloadError("not a PNG image", restart=True)
+    if not tail.endswith(PNG_TRAILER):
+        # Without a length to go by, a missing IEND chunk may just mean the transfer stopped early
+        raise DownloadError("the PNG has no IEND chunk", restart=expected_length is not None)
+
+# Function to check a downloaded file with check_png, reading only its first and last bytes
+def check_png_file(path, expected_length=None):
+    length = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        head = file.read(len(PNG_SIGNATURE))
+        file.seek(max(0, length - len(PNG_TRAILER)))
+        tail = file.read()
+    check_png(head, tail, length, expected_length)
+
+# Function to read the full size of an image from a download response, None if the server didn't say.
+# A 206 answers a Range request and gives the total after the slash of Content-Range: 'bytes 1000-4999/5000'
+def get_download_length(status_code, headers, offset=0):
+    if status_code == 206:
+        total = headers.get('content-range', '').rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+    length = headers.get('content-length')
+    return int(length) + offset if length and length.isdigit() else None
+
+# Function to get how long a download may take before a hedged second request is sent, None when hedging is off or there are too few samples yet
+def get_hedge_delay():
+    if not settings['download_hedge']:
+        return None
+    return metrics.estimate_percentile('download', 0.95)
+
+# Function to decode inline base64 image data straight into a file, a slice at a time
+def write_b64_image(image_b64, path, chunk_size=1024 * 1024):
+    temp_path = path + '.part'
+    with open(temp_path, 'wb') as file:
+        # Slices must be a multiple of 4 characters to decode independently
+        step = chunk_size - chunk_size % 4
+        for start in range(0, len(image_b64), step):
+            file.write(base64.b64decode(image_b64[start:start + step]))
+    os.replace(temp_path, path)
+
+# Function to write already downloaded image bytes to a temporary file and atomically move it into place
+def write_image_bytes(image_data, path):
+    temp_path = path + '.part'
+    with open(temp_path, 'wb') as file:
+        file.write(image_data)
+    os.replace(temp_path, path)
+
+# Function to stream an image into a temporary file, resuming with a Range request if an earlier attempt left part of it
+def fetch_image(image_url, temp_path, cancel=None, chunk_size=64 * 1024):
+    offset = os.path.getsize(temp_path) if os.path.exists(temp_path) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    with get_http_session().get(image_url, timeout=10, stream=True, headers=headers) as response:  # Timeout in seconds
+        if response.status_code == 416 and offset:
+            # The earlier attempt already had every byte
+            check_png_file(temp_path, get_download_length(206, {'content-range': response.headers.get('content-range', '')}))
+            return
+        if response.status_code not in (200, 206):
+            raise DownloadError(f"status code {response.status_code}", response.status_code in RETRYABLE_DOWNLOAD_STATUSES)
+        if response.status_code == 200:
+            offset = 0  # The server ignored the Range header and sent the whole image
+        expected_length = get_download_length(response.status_code, response.headers, offset)
+        with open(temp_path, 'ab' if offset else 'wb') as file:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if cancel is not None and cancel.is_set():
+                    raise DownloadError("cancelled", retryable=False)
+                file.write(chunk)
+    check_png_file(temp_path, expected_length)
+
+# Function to download an image into a temporary file, retrying with backoff and resuming what already arrived. Returns True once it is whole
+def fetch_image_with_retries(image_url, temp_path, cancel=None):
+    cancelled = lambda: cancel is not None and cancel.is_set()
+    attempt = 0
+    try:
+        while not cancelled():
+            try:
+                fetch_image(image_url, temp_path, cancel)
+                return True
+            except (requests.RequestException, DownloadError) as e:
+                if cancelled():
+                    break
+                if getattr(e, 'restart', False) and os.path.exists(temp_path):
+                    os.remove(temp_path)
+                if not getattr(e, 'retryable', True) or attempt >= settings['download_retries']:
+                    logger.warning("Failed to download the image (%s): %s", e, image_url)
+                    break
+                attempt += 1
+                metrics.increment('download_retries')
+                delay = get_backoff_delay(attempt, base=0.5, cap=10.0)
+                logger.info("Download failed (%s), retry %d/%d in %.1fs: %s", e, attempt, settings['download_retries'], delay, image_url)
+                time.sleep(delay)
+    except BaseException:
+        # Never leave a half-written file behind if something unexpected happened
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    return False
+
+# Download threads of hedged downloads, the slower one of each pair may still be stopping when a run ends
+hedge_threads = []
+hedge_threads_lock = threading.Lock()
+
+# Function to start a download thread for a hedged download
+def start_hedge_thread(target, path):
+    thread = threading.Thread(target=target, args=(path,), daemon=True)
+    with hedge_threads_lock:
+        hedge_threads[:] = [running for running in hedge_threads if running.is_alive()]
+        hedge_threads.append(thread)
+    thread.start()
+
+# Function to wait until the slower requests of hedged downloads have stopped and removed their files, called at the end of a run
+def wait_for_hedged_downloads():
+    with hedge_threads_lock:
+        threads = list(hedge_threads)
+        hedge_threads.clear()
+    for thread in threads:
+        thread.join()
+
+# Function to download an image, sending a hedged second request if the first one takes longer than the hedge delay.
+# Each request writes its own temporary file; returns the path of the one that finished first, or None
+def fetch_image_hedged(image_url, temp_path, hedge_delay):
+    results = queue.Queue()
+    cancel = threading.Event()
+    winner_lock = threading.Lock()
+
+    def fetch(path):
+        won = False
+        try:
+            fetched = fetch_image_with_retries(image_url, path, cancel)
+            with winner_lock:
+                won = fetched and not cancel.is_set()
+                if won:
+                    # The slower request stops at its next chunk and removes its own file
+                    cancel.set()
+            if fetched and not won:
+                os.remove(path)
+        except Exception as e:
+            # E.g. a full disk or a failed check, the download is lost but the caller must not wait for it forever
+            logger.warning("Failed to download the image (%s): %s", e, image_url)
+        finally:
+            results.put(path if won else None)
+
+    start_hedge_thread(fetch, temp_path)
+    try:
+        return results.get(timeout=hedge_delay)
+    except queue.Empty:
+        pass
+    metrics.increment('hedged_downloads')
+    start_hedge_thread(fetch, temp_path + '.hedge')
+    finished_path = results.get()
+    return finished_path if finished_path is not None else results.get()
+
+# Function to download an image to a temporary file and atomically move it into place once it is checked
+def download_image(image_url, path):
+    temp_path = path + '.part'
+    request_start = time.monotonic()
+    hedge_delay = get_hedge_delay()
+    if hedge_delay is None:
+        finished_path = temp_path if fetch_image_with_retries(image_url, temp_path) else None
+    else:
+        finished_path = fetch_image_hedged(image_url, temp_path, hedge_delay)
+    if finished_path is None:
+        return False
+    metrics.record('download', time.monotonic() - request_start)
+    os.replace(finished_path, path)
+    return True
+
+# Directories already created by this process, so saving an image doesn't hit the filesystem to create its folder again
+created_directories = set()
+created_directories_lock = threading.Lock()
+
+# Function to create a directory once per process (several workers may race to create it)
+def ensure_directory(directory):
+    if directory in created_directories:
+        return
+    os.makedirs(directory, exist_ok=True)
+    with created_directories_lock:
+        created_directories.add(directory)
+
+# Function to forget the directories created so far, called when a run starts since the output may have been moved or deleted in between
+def clear_created_directories():
+    with created_directories_lock:
+        created_directories.clear()
+
+# Function to get the shard folders of an image from its hash, e.g. depth 2 puts 'ab12...' in 'ab/12'
+def get_shard_path(hash_hex, depth):
+    return os.path.join(*(hash_hex[level * 2:level * 2 + 2] for level in range(depth))) if depth else ''
+
+# Function to collect the request details recorded in the manifest for each image
+def build_image_metadata(model_version, size, quality, generate_seconds):
+    return {
+        'model_version': model_version,
+        'size': size,
+        'quality': quality,
+        'cost': calculate_cost(model_version, size, quality, 1),
+        'generate_seconds': round(generate_seconds, 3),
+    }
+
+# Function to build the caption of an image from its prompt, concept and dataset
+def build_caption(prompt, concept, dataset):
+    # Always remove the concept and surrounding brackets from the prompt first
+    concept_with_brackets = f"[{concept}]" if concept else ""
+    prompt_without_concept = prompt.replace(concept_with_brackets, '').strip()
+
+    # Check the state of the conceptify variable and prepare the caption content accordingly
+    if concept:
+        # If conceptify is true, use only the concept
+        caption_content = concept
+    else:
+        # If conceptify is false, use the modified prompt without the concept
+        caption_content = prompt_without_concept
+
+    # If the dataset is provided, prepend it to the caption content
+    if dataset:
+        caption_content = f"{dataset} {caption_content}".strip()
+    return caption_content
+
+# Function to put the image file in place, from fetched bytes, inline base64 data, a cached file or its URL
+def store_image(image_url, image_path, image_b64=None, image_data=None, image_file=None):
+    # Cached images are hardlinked into place, or copied where the filesystem can't link them
+    if image_file:
+        write_start = time.monotonic()
+        try:
+            try:
+                os.link(image_file, image_path)
+            except OSError:
+                shutil.copyfile(image_file, image_path)
+        except OSError as e:
+            logger.warning("Could not reuse cached image %s: %s", image_file, e)
+            return False
+        metrics.record('write', time.monotonic() - write_start)
+        return True
+
+    # Images that were already fetched (e.g. by the asyncio pipeline) only need writing
+    if image_data is not None:
+        write_start = time.monotonic()
+        write_image_bytes(image_data, image_path)
+        metrics.record('write', time.monotonic() - write_start)
+        return True
+
+    # Inline base64 images need no second round trip
+    if image_b64:
+        write_start = time.monotonic()
+        write_b64_image(image_b64, image_path)
+        metrics.record('write', time.monotonic() - write_start)
+        return True
+
+    try:
+        return download_image(image_url, image_path)
+    except requests.Timeout:
+        logger.warning("Request timed out for URL: %s", image_url)
+    except requests.RequestException as e:
+        logger.warning("An error occurred: %s", e)
+    return False
+
+# Function to get the folder of a dataset for today, <date>/<dataset>, or just <date> without a dataset
+def get_dataset_directory(dataset, now=None):
+    base_directory = (now or datetime.now()).strftime("%Y-%m-%d")
+    # Check if 'dataset' has a truthy value (non-empty string) before adding it to the path
+    if dataset and dataset.strip():
+        base_directory = os.path.join(base_directory, dataset.strip())
+    return base_directory
+
+# Function to save the image URL to a text file, download the image, and optionally generate a caption file
+def save_image_details_and_download(image_url, prompt, generate_log, generate_caption, concept, dataset, image_b64=None, image_data=None, metadata=None, image_file=None):
+    # Get the current datetime for timestamping
+    now = datetime.now()
+    dataset_directory = get_dataset_directory(dataset, now)
+    base_directory = dataset_directory
+    if concept:
+        base_directory = os.path.join(base_directory, concept)
+
+    # A cached image that is already part of this dataset is not added a second time
+    if image_file and os.path.abspath(image_file).startswith(os.path.abspath(dataset_directory) + os.sep):
+        return image_file
+
+    # Create a hash of the image URL (or the inline image data, or the cached file) for a unique filename
+    hash_object = hashlib.md5((image_url or image_b64 or image_file).encode())
+    hash_hex = hash_object.hexdigest()
+
+    # In the sharded layout, images are spread over subfolders named after the start of their hash
+    shard_depth = settings['shard_depth']
+    if shard_depth:
+        base_directory = os.path.join(base_directory, get_shard_path(hash_hex, shard_depth))
+
+    # Create the directory if it does not exist
+    ensure_directory(base_directory)
+
+    # Log the intended save path
+    logger.debug("Intended save path: %s", os.path.abspath(base_directory))
+
+    # Define the filename prefix with dataset and concept if available
+    file_prefix = ""
+    if dataset:
+        file_prefix += f"{dataset} - "
+    if concept:
+        file_prefix += f"{concept} - "
+
+    # Define the filenames for the log file, the image file, and the caption file
+    formatted_time_str = now.strftime("%Y-%m-%d - %H.%M.%S")
+    log_filename = f"{file_prefix}{formatted_time_str} - {hash_hex}.log"
+    image_filename = f"{file_prefix}{formatted_time_str} - {hash_hex}.png"
+    caption_filename = f"{file_prefix}{formatted_time_str} - {hash_hex}.txt"
+
+    # In manifest mode the log and caption go into the dataset's manifest instead of sidecar files
+    manifest_mode = settings['manifest']
+    caption_content = build_caption(prompt, concept, dataset)
+
+    # Save the log file if "Generate Log" is checked
+    if generate_log and not manifest_mode:
+        with open(os.path.join(base_directory, log_filename), 'w') as file:
+            file.write(f"Prompt: {prompt}\n")
+            file.write(f"Image URL: {image_url or (f'cached ({image_file})' if image_file else 'inline (b64_json)')}\n")
+            file.write(f"Timestamp: {now}\n")
+
+    logger.debug("Generate Caption: %s", generate_caption)
+    # Save the caption file if "Generate Caption" is checked
+    if generate_caption and not manifest_mode:
+        # Log whether the caption uses the concept and the final caption content
+        logger.debug("Caption uses concept: %s", bool(concept))
+        logger.debug("Final caption content: %s", caption_content)
+
+        # Write the caption content to the file
+        with open(os.path.join(base_directory, caption_filename), 'w') as file:
+            file.write(caption_content)
+
+    # Download the image and save it to the appropriate directory
+    image_path = os.path.join(base_directory, image_filename)
+    store_start = time.monotonic()
+    if not store_image(image_url, image_path, image_b64, image_data, image_file):
+        # The image could not be downloaded
+        return None
+    # Reused images cost nothing, they are counted as reused instead
+    if not image_file:
+        metrics.add_image((metadata or {}).get('cost', 0.0))
+
+    # Record the image in the dataset's manifest, which is also the index of a sharded dataset
+    if manifest_mode or shard_depth:
+        record = {
+            'image': os.path.relpath(image_path, dataset_directory),
+            'prompt': prompt,
+            'concept': concept,
+            'caption': caption_content,
+            'dataset': dataset,
+            'url_hash': hash_hex,
+            'image_url': image_url,
+            'timestamp': now.isoformat(),
+            'store_seconds': round(time.monotonic() - store_start, 3),
+        }
+        record.update(metadata or {})
+        get_manifest_writer(dataset_directory).write(record)
+    return image_path
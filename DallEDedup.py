@@ -0,0 +1,272 @@
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from DallEPostprocess import FORMATS, THUMBNAIL_FOLDER
+
+logger = logging.getLogger(__name__)
+
+# Name of the index file written in the scanned folder
+INDEX_FILENAME = 'dedup_index.npz'
+
+# Name of the folder near-duplicates are moved to, next to the index
+QUARANTINE_FOLDER = 'quarantine'
+
+# Perceptual hashes stored in the index, both 64 bits
+HASH_KINDS = ('dhash', 'phash')
+
+# Sidecar files that belong to an image and move with it
+SIDECAR_EXTENSIONS = ('.txt', '.log')
+
+# Subfolders holding post-processed copies, scanned for copies of quarantined images but never hashed themselves
+DERIVED_FOLDER_PATTERN = re.compile(r'^\d+px$')
+
+# Pairs compared per block of the distance search, bounds memory to about 150MB whatever the dataset size
+SEARCH_BLOCK_PAIRS = 2 ** 24
+
+# Function to build the orthonormal DCT-II matrix used by the pHash
+def dct_matrix(size):
+    index = np.arange(size)
+    matrix = np.cos(np.pi * (2 * index[None, :] + 1) * index[:, None] / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+DCT_32 = dct_matrix(32)
+
+# Function to pack 64 booleans into one unsigned 64-bit integer
+def pack_bits(bits):
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+# Function to compute the difference hash: is each pixel of a 9x8 thumbnail brighter than its left neighbour
+def dhash(gray_image):
+    from PIL import Image
+    pixels = np.asarray(gray_image.resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    return pack_bits(pixels[:, 1:] > pixels[:, :-1])
+
+# Function to compute the DCT hash: is each of the 8x8 lowest frequencies of a 32x32 thumbnail above their median
+def phash(gray_image):
+    from PIL import Image
+    pixels = np.asarray(gray_image.resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    low = (DCT_32 @ pixels @ DCT_32.T)[:8, :8]
+    return pack_bits(low > np.median(low.ravel()[1:]))
+
+# Function to hash one image, runs in a worker process. Returns (path, dhash, phash), or (path, None, error) if it can't be read
+def hash_image(image_path):
+    from PIL import Image
+    try:
+        with Image.open(image_path) as image:
+            gray = image.convert('L')
+        return image_path, dhash(gray), phash(gray)
+    except Exception as e:
+        return image_path, None, str(e)
+
+# Function to tell whether a subfolder only holds copies made from other images
+def is_derived_folder(name):
+    return name in FORMATS or name == THUMBNAIL_FOLDER or name == QUARANTINE_FOLDER or bool(DERIVED_FOLDER_PATTERN.match(name))
+
+# Function to find the generated images in a folder tree, as paths relative to it
+def find_images(folder):
+    for directory, subdirectories, filenames in os.walk(folder):
+        subdirectories[:] = sorted(subdirectory for subdirectory in subdirectories if not is_derived_folder(subdirectory))
+        for filename in sorted(filenames):
+            if filename.lower().endswith('.png'):
+                yield os.path.relpath(os.path.join(directory, filename), folder)
+
+# Perceptual hashes of every image in a folder tree, kept as NumPy arrays and saved next to the images
+class HashIndex(object):
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, INDEX_FILENAME)
+        self.paths = np.array([], dtype=str)
+        self.mtimes = np.array([], dtype=np.float64)
+        self.sizes = np.array([], dtype=np.int64)
+        self.hashes = {kind: np.array([], dtype=np.uint64) for kind in HASH_KINDS}
+
+    # Function to load the saved index, if there is one
+    def load(self):
+        if not os.path.exists(self.path):
+            return self
+        with np.load(self.path) as data:
+            self.paths = data['paths']
+            self.mtimes = data['mtimes']
+            self.sizes = data['sizes']
+            self.hashes = {kind: data[kind] for kind in HASH_KINDS}
+        return self
+
+    # Function to save the index, written to a temporary file first so a crash never leaves half an index
+    def save(self):
+        temp_path = self.path + '.part'
+        with open(temp_path, 'wb') as file:
+            np.savez(file, paths=self.paths, mtimes=self.mtimes, sizes=self.sizes, **self.hashes)
+        os.replace(temp_path, self.path)
+
+    def __len__(self):
+        return len(self.paths)
+
+    # Function to bring the index in line with the folder: only new or changed images are hashed, in parallel
+    def update(self, workers=0):
+        known = {path: row for row, path in enumerate(self.paths.tolist())}
+        keep_rows = []
+        paths, mtimes, sizes, pending = [], [], [], []
+        for relative_path in find_images(self.folder):
+            stat = os.stat(os.path.join(self.folder, relative_path))
+            row = known.get(relative_path)
+            if row is not None and self.mtimes[row] == stat.st_mtime and self.sizes[row] == stat.st_size:
+                keep_rows.append(row)
+            else:
+                paths.append(relative_path)
+                mtimes.append(stat.st_mtime)
+                sizes.append(stat.st_size)
+                pending.append(os.path.join(self.folder, relative_path))
+
+        # Images that were removed or changed drop out here, changed ones are hashed again below
+        keep_rows = np.array(keep_rows, dtype=np.int64)
+        new_hashes = {kind: [] for kind in HASH_KINDS}
+        failed = set()
+        if pending:
+            with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+                for image_path, dhash_value, phash_value in executor.map(hash_image, pending, chunksize=64):
+                    if dhash_value is None:
+                        logger.warning("Could not hash %s: %s", image_path, phash_value)
+                        failed.add(image_path)
+                        dhash_value = phash_value = 0
+                    new_hashes['dhash'].append(dhash_value)
+                    new_hashes['phash'].append(phash_value)
+        valid = np.array([path not in failed for path in pending], dtype=bool)
+
+        self.paths = np.concatenate([self.paths[keep_rows], np.array(paths, dtype=str)[valid]]) if len(paths) else self.paths[keep_rows]
+        self.mtimes = np.concatenate([self.mtimes[keep_rows], np.array(mtimes, dtype=np.float64)[valid]])
+        self.sizes = np.concatenate([self.sizes[keep_rows], np.array(sizes, dtype=np.int64)[valid]])
+        for kind in HASH_KINDS:
+            self.hashes[kind] = np.concatenate([self.hashes[kind][keep_rows], np.array(new_hashes[kind], dtype=np.uint64)[valid]])
+        return int(valid.sum()), len(failed)
+
+    # Function to drop images from the index, e.g. after they were quarantined
+    def remove(self, rows):
+        keep = np.ones(len(self), dtype=bool)
+        keep[rows] = False
+        self.paths, self.mtimes, self.sizes = self.paths[keep], self.mtimes[keep], self.sizes[keep]
+        self.hashes = {kind: hashes[keep] for kind, hashes in self.hashes.items()}
+
+# Function to count the set bits of every element, using NumPy's popcount where it exists (NumPy 2.0+)
+if hasattr(np, 'bitwise_count'):
+    def popcount(values):
+        return np.bitwise_count(values)
+else:
+    BYTE_POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+    def popcount(values):
+        return BYTE_POPCOUNT[values.view(np.uint8).reshape(values.shape + (8,))].sum(axis=-1, dtype=np.uint8)
+
+# Function to find every pair of hashes within a Hamming distance, returned as arrays (first, second, distance) with first < second.
+# Each block of rows is compared against all later hashes in one vectorized step, so the only Python loop is over blocks
+def find_near_duplicates(hashes, threshold):
+    count = len(hashes)
+    firsts, seconds, distances = [], [], []
+    block = max(1, SEARCH_BLOCK_PAIRS // max(1, count))
+    for start in range(0, count, block):
+        end = min(start + block, count)
+        block_distances = popcount(hashes[start:end, None] ^ hashes[None, start:])
+        rows, columns = np.nonzero(block_distances <= threshold)
+        later = columns > rows
+        rows, columns = rows[later], columns[later]
+        firsts.append(rows + start)
+        seconds.append(columns + start)
+        distances.append(block_distances[rows, columns])
+    if not firsts:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.uint8)
+    return np.concatenate(firsts), np.concatenate(seconds), np.concatenate(distances)
+
+# Function to group duplicate pairs into clusters: every image gets the label of the lowest row it is connected to
+def cluster_pairs(count, firsts, seconds):
+    labels = np.arange(count)
+    while len(firsts):
+        lowest = np.minimum(labels[firsts], labels[seconds])
+        updated = labels.copy()
+        np.minimum.at(updated, firsts, lowest)
+        np.minimum.at(updated, seconds, lowest)
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            break
+        labels = updated
+    return labels
+
+# Function to list the clusters of near-duplicates, each one sorted so the image to keep (the oldest) comes first
+def find_clusters(index, kind='dhash', threshold=6):
+    firsts, seconds, _ = find_near_duplicates(index.hashes[kind], threshold)
+    if not len(firsts):
+        return []
+    labels = cluster_pairs(len(index), firsts, seconds)
+    members = np.unique(np.concatenate([firsts, seconds]))
+    order = np.lexsort((index.paths[members], index.mtimes[members], labels[members]))
+    members = members[order]
+    boundaries = np.flatnonzero(np.diff(labels[members])) + 1
+    return [cluster.tolist() for cluster in np.split(members, boundaries)]
+
+# Function to move an image, its sidecars and its post-processed copies into the quarantine folder, keeping the folder layout
+def quarantine_image(folder, relative_path):
+    source_directory, filename = os.path.split(os.path.join(folder, relative_path))
+    target_directory = os.path.join(folder, QUARANTINE_FOLDER, os.path.dirname(relative_path))
+    name = os.path.splitext(filename)[0]
+    moves = [(os.path.join(source_directory, filename), os.path.join(target_directory, filename))]
+    moves += [(os.path.join(source_directory, name + extension), os.path.join(target_directory, name + extension)) for extension in SIDECAR_EXTENSIONS]
+    for subdirectory in os.listdir(source_directory):
+        if is_derived_folder(subdirectory) and subdirectory != QUARANTINE_FOLDER and os.path.isdir(os.path.join(source_directory, subdirectory)):
+            for derived in os.listdir(os.path.join(source_directory, subdirectory)):
+                if os.path.splitext(derived)[0] == name:
+                    moves.append((os.path.join(source_directory, subdirectory, derived), os.path.join(target_directory, subdirectory, derived)))
+    for source, target in moves:
+        if os.path.exists(source):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.move(source, target)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find near-duplicate images in a generated dataset with perceptual hashes.")
+    parser.add_argument('folder', help="Folder to scan, e.g. a dataset folder; subfolders are included and the index is saved here")
+    parser.add_argument('--hash', choices=HASH_KINDS, default='dhash', help="Perceptual hash to compare; both are stored in the index")
+    parser.add_argument('--threshold', type=int, default=6, help="Largest Hamming distance (out of 64 bits) that counts as a near-duplicate")
+    parser.add_argument('--quarantine', action='store_true', help=f"Move every near-duplicate but the oldest of each cluster to a '{QUARANTINE_FOLDER}' subfolder")
+    parser.add_argument('--report', default=None, help="Write the clusters to this JSON file")
+    parser.add_argument('--workers', type=int, default=0, help="Hashing processes, 0 for one per core")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    start = time.monotonic()
+    index = HashIndex(args.folder).load()
+    hashed, failed = index.update(args.workers)
+    index.save()
+    hashing_seconds = time.monotonic() - start
+    print(f"Indexed {len(index)} images ({hashed} newly hashed, {failed} unreadable) in {hashing_seconds:.1f}s.")
+
+    start = time.monotonic()
+    clusters = find_clusters(index, args.hash, args.threshold)
+    duplicates = sum(len(cluster) - 1 for cluster in clusters)
+    print(f"Found {len(clusters)} clusters with {duplicates} near-duplicates in {time.monotonic() - start:.1f}s.")
+    for cluster in clusters:
+        print(f"  keep {index.paths[cluster[0]]}")
+        for row in cluster[1:]:
+            print(f"    duplicate {index.paths[row]}")
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as file:
+            json.dump([{'keep': str(index.paths[cluster[0]]), 'duplicates': [str(index.paths[row]) for row in cluster[1:]]} for cluster in clusters], file, indent=2)
+
+    if args.quarantine and duplicates:
+        quarantined = [row for cluster in clusters for row in cluster[1:]]
+        for row in quarantined:
+            quarantine_image(args.folder, str(index.paths[row]))
+        index.remove(quarantined)
+        index.save()
+        print(f"Moved {len(quarantined)} near-duplicates to {os.path.join(args.folder, QUARANTINE_FOLDER)}.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
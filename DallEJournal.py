@@ -0,0 +1,122 @@
+import hashlib
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+# Job states in the order a job moves through them, 'failed' jobs are retried on resume like unfinished ones
+JOB_STATES = ['queued', 'requested', 'downloaded', 'written', 'failed']
+
+# Function to build a stable id for one prompt x copy job, so a rerun of the same job maps to the same journal row
+def make_job_id(prompt, copy_index, model_version, size, quality, dataset):
+    key = json.dumps([prompt, copy_index, model_version, size, quality, dataset or ''], ensure_ascii=False)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+# On-disk SQLite journal of job states, written in batches by a background thread
+class JobJournal(object):
+    def __init__(self, path, batch_size=256, flush_interval=0.5):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = queue.Queue()
+        self.closed = False
+        self.write_lock = threading.Lock()  # Reads share the connection with the writer thread
+
+        # Open the journal, creating the jobs table on first use
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                prompt TEXT,
+                copy_index INTEGER,
+                state TEXT NOT NULL,
+                image_path TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL
+            )""")
+        self.connection.commit()
+
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    # Function to get the ids of every job that has already been written, read once before a run starts
+    def completed_job_ids(self):
+        self.flush()
+        with self.write_lock:
+            rows = self.connection.execute("SELECT job_id FROM jobs WHERE state = 'written'").fetchall()
+        return set(row[0] for row in rows)
+
+    # Function to count the jobs in each state
+    def state_counts(self):
+        self.flush()
+        with self.write_lock:
+            rows = self.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return dict(rows)
+
+    # Function to queue a state change, it reaches the disk with the next batch
+    def record(self, job_id, state, prompt=None, copy_index=None, image_path=None):
+        if state not in JOB_STATES:
+            raise ValueError(f"Unknown job state: {state}")
+        self.pending.put((job_id, prompt, copy_index, state, image_path, 1 if state == 'requested' else 0, time.time()))
+
+    # Function to block until every queued state change is on disk
+    def flush(self):
+        done = threading.Event()
+        self.pending.put(done)
+        done.wait()
+
+    # Function to flush the remaining state changes and close the journal
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self.closed = True
+        self.pending.put(None)
+        self.writer.join()
+        self.connection.close()
+
+    def write_loop(self):
+        while True:
+            item = self.pending.get()
+            batch = []
+            events = []
+            deadline = time.monotonic() + self.flush_interval
+            # Gather everything that arrives within the flush interval, up to one batch
+            while True:
+                if item is None:
+                    self.write_batch(batch)
+                    for event in events:
+                        event.set()
+                    return
+                if isinstance(item, threading.Event):
+                    events.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.pending.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            self.write_batch(batch)
+            for event in events:
+                event.set()
+
+    def write_batch(self, batch):
+        if not batch:
+            return
+        with self.write_lock:
+            self.connection.executemany("""
+                INSERT INTO jobs (job_id, prompt, copy_index, state, image_path, attempts, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(job_id) DO UPDATE SET
+                    prompt = COALESCE(excluded.prompt, jobs.prompt),
+                    copy_index = COALESCE(excluded.copy_index, jobs.copy_index),
+                    state = excluded.state,
+                    image_path = COALESCE(excluded.image_path, jobs.image_path),
+                    attempts = jobs.attempts + excluded.attempts,
+                    updated_at = excluded.updated_at""", batch)
+            self.connection.commit()
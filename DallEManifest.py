@@ -0,0 +1,131 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import threading
+import time
+
+# Name of the manifest file kept in every dataset folder
+MANIFEST_FILENAME = 'manifest.jsonl'
+
+# Name this process writes its records to, workers sharing a dataset folder each get their own (manifest.<worker>.jsonl)
+manifest_filename = MANIFEST_FILENAME
+
+# Buffered, append-only JSONL manifest, one record per saved image
+class ManifestWriter(object):
+    def __init__(self, path, batch_size=100, flush_interval=5.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Function to add a record, it reaches the disk with the next batch
+    def write(self, record):
+        with self.lock:
+            self.buffer.append(json.dumps(record, ensure_ascii=False))
+            if len(self.buffer) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush_locked()
+
+    # Function to append every buffered record to the manifest file
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.write('\n'.join(self.buffer) + '\n')
+        self.buffer = []
+
+# Open manifest writers, one per dataset folder
+manifest_writers = {}
+manifest_lock = threading.Lock()
+
+# Function to make this process write its own manifest in every dataset folder, because appends from
+# several machines to one file on NFS or SMB are not atomic and their lines could interleave
+def use_worker_manifest(worker_id):
+    global manifest_filename
+    manifest_filename = f"{os.path.splitext(MANIFEST_FILENAME)[0]}.{worker_id}.jsonl"
+
+# Function to get the shared manifest writer of a dataset folder
+def get_manifest_writer(directory):
+    path = os.path.join(directory, manifest_filename)
+    with manifest_lock:
+        if path not in manifest_writers:
+            manifest_writers[path] = ManifestWriter(path)
+        return manifest_writers[path]
+
+# Function to flush every open manifest, called at the end of a run
+def flush_manifests():
+    with manifest_lock:
+        writers = list(manifest_writers.values())
+    for writer in writers:
+        writer.flush()
+
+# Function to find the manifests of a dataset from its folder or its manifest.jsonl: the main one plus the per-worker ones next to it
+def find_manifests(path):
+    directory = path if os.path.isdir(path) else os.path.dirname(os.path.abspath(path))
+    stem = os.path.splitext(MANIFEST_FILENAME)[0]
+    main_path = os.path.join(directory, MANIFEST_FILENAME)
+    worker_paths = sorted(glob.glob(os.path.join(glob.escape(directory), f"{stem}.*.jsonl")))
+    return ([main_path] if os.path.exists(main_path) else []) + worker_paths
+
+# Function to read the records of a dataset's manifests one at a time
+def read_manifest(path):
+    for manifest_path in find_manifests(path):
+        with open(manifest_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+# Function to list a dataset's images from its manifest, without walking the folder tree.
+# Yields (image path, record); images that were removed since are left out unless include_missing is set
+def iter_dataset(path, include_missing=False):
+    directory = path if os.path.isdir(path) else os.path.dirname(os.path.abspath(path))
+    for record in read_manifest(path):
+        image_path = os.path.join(directory, record['image'])
+        if include_missing or os.path.exists(image_path):
+            yield image_path, record
+
+# Function to write the per-image caption files a trainer expects, in one pass over the manifest
+def export_captions(path, overwrite=False):
+    directory = path if os.path.isdir(path) else os.path.dirname(os.path.abspath(path))
+    written = 0
+    for record in read_manifest(path):
+        image_path = os.path.join(directory, record['image'])
+        caption_path = os.path.splitext(image_path)[0] + '.txt'
+        if not os.path.exists(image_path) or (os.path.exists(caption_path) and not overwrite):
+            continue
+        with open(caption_path, 'w', encoding='utf-8') as file:
+            file.write(record['caption'])
+        written += 1
+    return written
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Work with dataset manifests written in manifest mode.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export-captions', help="Write a .txt caption next to every image listed in a manifest")
+    export_parser.add_argument('manifest', help=f"Path to a {MANIFEST_FILENAME} or its dataset folder, per-worker manifests next to it are included")
+    export_parser.add_argument('--overwrite', action='store_true', help="Replace caption files that already exist")
+    list_parser = subparsers.add_parser('list', help="Print the images listed in a manifest, one per line")
+    list_parser.add_argument('manifest', help=f"Path to a {MANIFEST_FILENAME} or its dataset folder, per-worker manifests next to it are included")
+    list_parser.add_argument('--captions', action='store_true', help="Print the caption after each image, separated by a tab")
+    list_parser.add_argument('--no-check', action='store_true', help="Don't check that each image still exists, for the fastest listing")
+    args = parser.parse_args(argv)
+
+    if args.command == 'list':
+        for image_path, record in iter_dataset(args.manifest, include_missing=args.no_check):
+            print(f"{image_path}\t{record['caption']}" if args.captions else image_path)
+        return 0
+
+    written = export_captions(args.manifest, args.overwrite)
+    print(f"Wrote {written} caption files.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
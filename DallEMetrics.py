@@ -0,0 +1,290 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0]
+
+# Counters every run reports, even when they stay at zero
+COUNTERS = ['requests', 'retries', 'rate_limited', 'jobs_failed', 'reused', 'download_retries', 'hedged_downloads']
+
+# Counters kept for every API key of the pool
+KEY_COUNTERS = ['requests', 'images', 'spend', 'rate_limited', 'errors']
+
+# Third-party loggers that are too chatty at INFO level
+QUIET_LOGGERS = ['httpx', 'httpcore', 'openai', 'urllib3']
+
+# Log formatter that writes one JSON object per line, including any extra fields passed to the logger
+class JsonLogFormatter(logging.Formatter):
+    STANDARD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in self.STANDARD_FIELDS})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+# Function to send log output to stdout, as plain text or JSON lines
+def setup_logging(level='INFO', log_format='text'):
+    handler = logging.StreamHandler(sys.stdout)
+    if log_format == 'json':
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-7s %(message)s', '%H:%M:%S'))
+    root_logger = logging.getLogger()
+    root_logger.handlers[:] = [handler]
+    root_logger.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+
+    # The HTTP libraries log every request at INFO level; only show that when debugging
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.NOTSET if root_logger.level <= logging.DEBUG else logging.WARNING)
+
+# Per-run latency histograms, counters, throughput and spend
+class RunMetrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.samples = {}
+            self.buckets = {}
+            self.counters = dict.fromkeys(COUNTERS, 0)
+            self.images = 0
+            self.spend = 0.0
+            self.keys = {}
+            self.concurrency = {}
+
+    # Function to record how long one request spent in a stage (api, download, write)
+    def record(self, stage, seconds):
+        with self.lock:
+            self.samples.setdefault(stage, []).append(seconds)
+            buckets = self.buckets.setdefault(stage, [0] * len(LATENCY_BUCKETS))
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    buckets[index] += 1
+                    break
+
+    def increment(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    # Function to count a saved image and what it cost
+    def add_image(self, cost):
+        with self.lock:
+            self.images += 1
+            self.spend += cost
+
+    # Function to estimate a latency percentile from the histogram, as the upper bound of the bucket it falls in.
+    # Cheap enough to call per request; None until the stage has min_samples samples or if it falls past the last bucket
+    def estimate_percentile(self, stage, fraction, min_samples=20):
+        with self.lock:
+            buckets = self.buckets.get(stage)
+            total = len(self.samples.get(stage, ()))
+            if not buckets or total < min_samples:
+                return None
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, buckets):
+                cumulative += count
+                if cumulative >= fraction * total:
+                    return bound
+        return None
+
+    # Function to add to the counters of one API key
+    def add_key_counts(self, key_name, **amounts):
+        with self.lock:
+            counts = self.keys.setdefault(key_name, dict.fromkeys(KEY_COUNTERS, 0))
+            for counter, amount in amounts.items():
+                counts[counter] += amount
+
+    # Function to record a change of the adaptive in-flight limit of one model/size/quality combination
+    def record_concurrency_limit(self, combination, limit, reason):
+        with self.lock:
+            self.concurrency.setdefault(combination, []).append((round(time.time() - self.started, 3), limit, reason))
+
+    def has_concurrency_limit(self, combination):
+        with self.lock:
+            return combination in self.concurrency
+
+    def images_per_minute(self):
+        elapsed = max(time.time() - self.started, 1e-9)
+        return self.images / elapsed * 60
+
+    # Function to build the JSON-ready summary of the run so far
+    def summary(self):
+        with self.lock:
+            latency = {}
+            for stage, samples in self.samples.items():
+                ordered = sorted(samples)
+                percentile = lambda p: ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+                latency[stage] = {
+                    'count': len(ordered),
+                    'first': round(samples[0], 4),
+                    'mean': round(sum(ordered) / len(ordered), 4),
+                    'p50': round(percentile(0.50), 4),
+                    'p95': round(percentile(0.95), 4),
+                    'p99': round(percentile(0.99), 4),
+                    'max': round(ordered[-1], 4),
+                }
+            elapsed = max(time.time() - self.started, 1e-9)
+            keys = {name: dict(counts, spend=round(counts['spend'], 4), images_per_minute=round(counts['images'] / elapsed * 60, 2))
+                    for name, counts in self.keys.items()}
+            concurrency = {combination: {'limit': changes[-1][1], 'min': min(change[1] for change in changes),
+                                         'max': max(change[1] for change in changes), 'changes': [list(change) for change in changes]}
+                           for combination, changes in self.concurrency.items()}
+            return {
+                'started': self.started,
+                'elapsed_seconds': round(time.time() - self.started, 3),
+                'images': self.images,
+                'images_per_minute': round(self.images / max(time.time() - self.started, 1e-9) * 60, 2),
+                'spend': round(self.spend, 4),
+                'counters': dict(self.counters),
+                'latency': latency,
+                'keys': keys,
+                'concurrency': concurrency,
+            }
+
+    # Function to describe the summary as a few human readable lines
+    def summary_lines(self):
+        summary = self.summary()
+        lines = [f"{summary['images']} images in {summary['elapsed_seconds']:.1f}s ({summary['images_per_minute']:.1f}/min), "
+                 f"spent ${summary['spend']:.2f}, " + ", ".join(f"{name} {value}" for name, value in summary['counters'].items())]
+        for stage, stats in summary['latency'].items():
+            lines.append(f"{stage}: {stats['count']} requests, first {stats['first']:.2f}s, mean {stats['mean']:.2f}s, "
+                         f"p50 {stats['p50']:.2f}s, p95 {stats['p95']:.2f}s, p99 {stats['p99']:.2f}s, max {stats['max']:.2f}s")
+        # Per-key lines only add something once there is more than one key
+        if len(summary['keys']) > 1:
+            for name, counts in summary['keys'].items():
+                lines.append(f"key {name}: {counts['requests']} requests, {counts['images']} images ({counts['images_per_minute']:.1f}/min), "
+                             f"spent ${counts['spend']:.2f}, rate_limited {counts['rate_limited']}, errors {counts['errors']}")
+        for combination, limits in summary['concurrency'].items():
+            lines.append(f"concurrency {combination}: limit {limits['limit']} (min {limits['min']}, max {limits['max']}, {len(limits['changes'])} changes)")
+        return lines
+
+    # Function to render the metrics in the Prometheus text exposition format
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for stage in self.buckets:
+                name = f"dalle_{stage}_seconds"
+                lines.append(f"# TYPE {name} histogram")
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, self.buckets[stage]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{le="+Inf"}} {len(self.samples[stage])}')
+                lines.append(f"{name}_sum {sum(self.samples[stage]):.6f}")
+                lines.append(f"{name}_count {len(self.samples[stage])}")
+            for counter, value in self.counters.items():
+                lines.append(f"# TYPE dalle_{counter}_total counter")
+                lines.append(f"dalle_{counter}_total {value}")
+            for counter in KEY_COUNTERS:
+                name = 'dalle_key_spend_dollars' if counter == 'spend' else f"dalle_key_{counter}_total"
+                if self.keys:
+                    lines.append(f"# TYPE {name} counter")
+                for key_name, counts in self.keys.items():
+                    lines.append(f'{name}{{key="{key_name}"}} {counts[counter]}')
+            if self.concurrency:
+                lines.append("# TYPE dalle_concurrency_limit gauge")
+            for combination, changes in self.concurrency.items():
+                lines.append(f'dalle_concurrency_limit{{combination="{combination}"}} {changes[-1][1]}')
+            lines.append("# TYPE dalle_images_total counter")
+            lines.append(f"dalle_images_total {self.images}")
+            lines.append("# TYPE dalle_spend_dollars counter")
+            lines.append(f"dalle_spend_dollars {self.spend:.4f}")
+        lines.append("# TYPE dalle_images_per_minute gauge")
+        lines.append(f"dalle_images_per_minute {self.images_per_minute():.4f}")
+        return '\n'.join(lines) + '\n'
+
+    # Function to write the summary of the run to a JSON file
+    def write_json(self, path):
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.summary(), file, indent=2)
+
+# Shared metrics of the current run
+metrics = RunMetrics()
+
+# Publishes the metrics while a run is going, to a Prometheus text file and/or an HTTP /metrics endpoint
+class MetricsExporter(object):
+    def __init__(self, run_metrics, prometheus_file=None, prometheus_port=0, interval=5.0, prometheus_host='127.0.0.1'):
+        self.metrics = run_metrics
+        self.prometheus_file = prometheus_file
+        self.prometheus_port = prometheus_port
+        self.prometheus_host = prometheus_host
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+        self.server = None
+
+    def start(self):
+        if self.prometheus_file:
+            self.thread = threading.Thread(target=self.write_loop, daemon=True)
+            self.thread.start()
+        if self.prometheus_port:
+            # Only imported when the endpoint is enabled, to keep startup lean
+            from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+            exporter = self
+
+            class MetricsHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = exporter.metrics.to_prometheus().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            # Only reachable from this machine unless another bind address is configured
+            self.server = ThreadingHTTPServer((self.prometheus_host, self.prometheus_port), MetricsHandler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            logger.info("Serving metrics on http://%s:%d/metrics", self.prometheus_host or '0.0.0.0', self.prometheus_port)
+        return self
+
+    def write_file(self):
+        temp_path = self.prometheus_file + '.part'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(self.metrics.to_prometheus())
+        os.replace(temp_path, self.prometheus_file)
+
+    def write_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.write_file()
+
+    # Function to stop publishing, the Prometheus file is written one last time
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.write_file()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+# Function to start publishing the metrics of a run as configured in the settings
+def start_metrics_export(settings):
+    metrics.reset()
+    return MetricsExporter(metrics, settings['prometheus_file'] or None, settings['prometheus_port'], prometheus_host=settings['prometheus_host']).start()
+
+# Function to stop publishing and report the metrics at the end of a run
+def finish_metrics_export(exporter, settings):
+    exporter.stop()
+    for line in metrics.summary_lines():
+        logger.info("Metrics %s", line)
+    if settings['metrics_json']:
+        metrics.write_json(settings['metrics_json'])
+        logger.info("Metrics summary written to %s", settings['metrics_json'])
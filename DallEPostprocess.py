@@ -0,0 +1,210 @@
+import argparse
+import importlib.util
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
+
+# Pillow save format and file extension of each output format
+FORMATS = {
+    'webp': ('WEBP', '.webp'),
+    'jpeg': ('JPEG', '.jpg'),
+    'png': ('PNG', '.png'),
+}
+
+# Name of the folder thumbnails are written to, next to the images
+THUMBNAIL_FOLDER = 'thumbnails'
+
+# Function to build the post-processing options from the settings, None if post-processing is off
+def get_postprocess_options(settings):
+    sizes = [int(size) for size in str(settings['postprocess_sizes']).replace(' ', '').split(',') if size]
+    if not (settings['postprocess_format'] or sizes or settings['postprocess_thumbnail']):
+        return None
+    return {
+        'format': settings['postprocess_format'] or None,
+        'quality': settings['postprocess_quality'],
+        'sizes': sizes,
+        'thumbnail': settings['postprocess_thumbnail'],
+        'overwrite': False,
+    }
+
+# Function to pick the training bucket for an image: about resolution² pixels, sides a multiple of 64, closest to the image's aspect ratio
+def get_bucket_size(width, height, resolution, step=64):
+    aspect = width / height
+    bucket_width = max(step, round((resolution * resolution * aspect) ** 0.5 / step) * step)
+    bucket_height = max(step, round(resolution * resolution / bucket_width / step) * step)
+    return bucket_width, bucket_height
+
+# Function to resize an image to cover a size and crop the overflow evenly from both sides
+def resize_and_crop(image, size):
+    from PIL import Image, ImageOps
+    return ImageOps.fit(image, size, Image.LANCZOS)
+
+# Function to save an image in an output format, dropping the alpha channel for formats without one
+def save_image(image, path, image_format, quality):
+    pil_format, _ = FORMATS[image_format]
+    if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    temp_path = path + '.part'
+    if pil_format == 'PNG':
+        image.save(temp_path, pil_format, optimize=True)
+    else:
+        image.save(temp_path, pil_format, quality=quality)
+    os.replace(temp_path, path)
+
+# Function to copy an image's caption next to one of its derived copies, trainers read the two in pairs
+def copy_caption(image_path, output_path):
+    caption_path = os.path.splitext(image_path)[0] + '.txt'
+    if os.path.exists(caption_path):
+        shutil.copyfile(caption_path, os.path.splitext(output_path)[0] + '.txt')
+
+# Function to post-process one saved image, runs in a worker process. Returns the paths written
+def process_image(image_path, options):
+    from PIL import Image
+
+    directory, filename = os.path.split(image_path)
+    name = os.path.splitext(filename)[0]
+    image_format = options['format'] or 'png'
+    extension = FORMATS[image_format][1]
+    written = []
+
+    # Function to tell whether an output still needs writing
+    def wanted(path):
+        return options['overwrite'] or not os.path.exists(path)
+
+    with Image.open(image_path) as image:
+        image.load()
+
+        # Full size copy in the chosen format
+        if options['format']:
+            output_path = os.path.join(directory, options['format'], name + extension)
+            if wanted(output_path):
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                save_image(image, output_path, image_format, options['quality'])
+                copy_caption(image_path, output_path)
+                written.append(output_path)
+
+        # Copies cropped to the training bucket of every requested resolution
+        for resolution in options['sizes']:
+            output_path = os.path.join(directory, f"{resolution}px", name + extension)
+            if wanted(output_path):
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                save_image(resize_and_crop(image, get_bucket_size(image.width, image.height, resolution)), output_path, image_format, options['quality'])
+                copy_caption(image_path, output_path)
+                written.append(output_path)
+
+        # Small preview that keeps the aspect ratio
+        if options['thumbnail']:
+            thumbnail_format = options['format'] if options['format'] in ('webp', 'jpeg') else 'jpeg'
+            output_path = os.path.join(directory, THUMBNAIL_FOLDER, name + FORMATS[thumbnail_format][1])
+            if wanted(output_path):
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                thumbnail = image.copy()
+                thumbnail.thumbnail((options['thumbnail'], options['thumbnail']), Image.LANCZOS)
+                save_image(thumbnail, output_path, thumbnail_format, 80)
+                written.append(output_path)
+    return written
+
+# Post-processing stage: saved images are handed to a process pool so conversions use every core
+class PostProcessor(object):
+    def __init__(self, options, workers=0):
+        self.options = options
+        # The pool starts mid-run next to worker, journal and exporter threads, forking then could copy a held lock into the children
+        self.executor = ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=multiprocessing.get_context('spawn'))
+        self.futures = {}
+        self.processed = 0
+        self.failed = []
+
+    # Function to queue a saved image for post-processing
+    def submit(self, image_path):
+        self.collect_finished()
+        self.futures[self.executor.submit(process_image, image_path, self.options)] = image_path
+
+    # Function to record the images that have been processed so far
+    def collect_finished(self):
+        for future in [future for future in self.futures if future.done()]:
+            self.collect(future)
+
+    def collect(self, future):
+        image_path = self.futures.pop(future)
+        try:
+            future.result()
+            self.processed += 1
+        except Exception as e:
+            logger.warning("Post-processing failed for %s: %s", image_path, e)
+            self.failed.append(image_path)
+
+    # Function to wait for every queued image and shut the pool down
+    def close(self):
+        for future in as_completed(list(self.futures)):
+            self.collect(future)
+        self.executor.shutdown()
+        logger.info("Post-processed %d images, %d failed.", self.processed, len(self.failed))
+
+# Function to start the post-processing stage if it is enabled in the settings, None otherwise
+def start_postprocessor(settings):
+    options = get_postprocess_options(settings)
+    if options is None:
+        return None
+    if importlib.util.find_spec('PIL') is None:
+        logger.error("Post-processing needs Pillow (pip install pillow), images will be saved without it.")
+        return None
+    return PostProcessor(options, settings['postprocess_workers'])
+
+# Function to find the generated images in a folder tree, leaving out the copies post-processing made
+def find_images(folder, sizes):
+    output_folders = {THUMBNAIL_FOLDER, *FORMATS, *(f"{size}px" for size in sizes)}
+    for directory, subdirectories, filenames in os.walk(folder):
+        subdirectories[:] = [subdirectory for subdirectory in subdirectories if subdirectory not in output_folders]
+        for filename in filenames:
+            if filename.lower().endswith('.png'):
+                yield os.path.join(directory, filename)
+
+# Function to post-process every image under a folder, e.g. an existing dated output folder
+def process_folder(folder, options, workers=0):
+    start = time.monotonic()
+    processed = 0
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = {executor.submit(process_image, image_path, options): image_path for image_path in find_images(folder, options['sizes'])}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                processed += 1
+            except Exception as e:
+                logger.warning("Post-processing failed for %s: %s", futures[future], e)
+                failed += 1
+    return processed, failed, time.monotonic() - start
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert, resize and thumbnail generated images in bulk, using every core.")
+    parser.add_argument('folder', help="Output folder to process, e.g. a dated folder; subfolders are included")
+    parser.add_argument('--format', choices=sorted(FORMATS), default=None, help="Write a full size copy in this format")
+    parser.add_argument('--quality', type=int, default=90, help="WebP/JPEG quality")
+    parser.add_argument('--sizes', default='', help="Comma separated training resolutions, e.g. 512,1024; each writes a copy cropped to the nearest training bucket")
+    parser.add_argument('--thumbnail', type=int, default=0, help="Longest side of the thumbnails, 0 for none")
+    parser.add_argument('--workers', type=int, default=0, help="Worker processes, 0 for one per core")
+    parser.add_argument('--overwrite', action='store_true', help="Redo copies that already exist")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    options = {
+        'format': args.format,
+        'quality': args.quality,
+        'sizes': [int(size) for size in args.sizes.split(',') if size.strip()],
+        'thumbnail': args.thumbnail,
+        'overwrite': args.overwrite,
+    }
+    if not (options['format'] or options['sizes'] or options['thumbnail']):
+        parser.error("nothing to do, pass --format, --sizes and/or --thumbnail")
+    processed, failed, seconds = process_folder(args.folder, options, args.workers)
+    print(f"Processed {processed} images in {seconds:.1f}s, {failed} failed.")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
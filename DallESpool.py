@@ -0,0 +1,311 @@
+import argparse
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from DallECore import settings, PromptTemplate, batch_copies, create_images_thread, get_http_session, clear_created_directories, wait_for_hedged_downloads, mark_startup_phase, report_startup
+from DallEBatch import load_jobs, estimate_job
+from DallEJournal import make_job_id
+from DallEManifest import flush_manifests, use_worker_manifest
+from DallEMetrics import metrics, setup_logging, start_metrics_export, finish_metrics_export
+from DallEPostprocess import start_postprocessor
+
+logger = logging.getLogger('DallESpool')
+
+# Folders of a spool directory, a job file moves through them with atomic renames
+SPOOL_FOLDERS = ['incoming', 'pending', 'claimed', 'done', 'failed']
+
+# Separates the job name from the worker holding it in the name of a claimed job file
+CLAIM_SEPARATOR = '@'
+
+# Function to build an id for this worker that is unique across machines
+def make_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}".replace(CLAIM_SEPARATOR, '-')
+
+# Function to get the name of a job file from the name it has in any folder, claimed ones carry the worker after the separator
+def get_job_name(filename):
+    return os.path.splitext(filename.split(CLAIM_SEPARATOR)[0])[0] + '.json'
+
+# Function to write a JSON file so it appears in one step: written to the incoming folder first, then renamed into place
+def write_json_atomically(incoming_directory, path, data):
+    temp_path = os.path.join(incoming_directory, f"{os.path.basename(path)}.{os.getpid()}.part")
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(data, file, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+# Job queue kept as one small JSON file per request in a directory on shared storage
+class Spool(object):
+    def __init__(self, path):
+        self.path = path
+        self.folders = {name: os.path.join(path, name) for name in SPOOL_FOLDERS}
+        for folder in self.folders.values():
+            os.makedirs(folder, exist_ok=True)
+        self.candidates = []  # Pending job files seen by the last scan, tried before scanning again
+
+    # Function to count the job files in each folder
+    def counts(self):
+        return {name: sum(1 for entry in os.scandir(folder) if entry.name.endswith('.json')) for name, folder in self.folders.items() if name != 'incoming'}
+
+    # Function to get the names of every job already in the spool, whatever its state
+    def known_names(self):
+        names = set()
+        for name in ('pending', 'claimed', 'done', 'failed'):
+            for entry in os.scandir(self.folders[name]):
+                if entry.name.endswith('.json'):
+                    names.add(get_job_name(entry.name))
+        return names
+
+    # Function to add a job file to the pending folder
+    def submit(self, name, job):
+        write_json_atomically(self.folders['incoming'], os.path.join(self.folders['pending'], name), job)
+
+    # Function to claim the next pending job, returns (claim path, job) or None when nothing is pending.
+    # The rename only succeeds for one worker, the others move on to the next file
+    def claim(self, worker_id):
+        for _ in range(2):
+            while self.candidates:
+                name = self.candidates.pop()
+                claim_path = os.path.join(self.folders['claimed'], f"{os.path.splitext(name)[0]}{CLAIM_SEPARATOR}{worker_id}.json")
+                try:
+                    os.rename(os.path.join(self.folders['pending'], name), claim_path)
+                except FileNotFoundError:
+                    continue
+                # The claim's modification time is its lease, renewed while the job runs
+                os.utime(claim_path)
+                with open(claim_path, 'r', encoding='utf-8') as file:
+                    return claim_path, json.load(file)
+            # Workers start from different places in the listing so they rarely race for the same file
+            self.candidates = [entry.name for entry in os.scandir(self.folders['pending']) if entry.name.endswith('.json')]
+            random.shuffle(self.candidates)
+        return None
+
+    # Function to renew the leases of the jobs this worker holds, returns the claims that were taken away
+    def renew(self, claim_paths):
+        lost = []
+        for claim_path in claim_paths:
+            try:
+                os.utime(claim_path)
+            except FileNotFoundError:
+                lost.append(claim_path)
+        return lost
+
+    # Function to put claims whose lease ran out back into the pending folder, e.g. after a worker crashed
+    def reclaim_stale(self, lease_seconds):
+        cutoff = time.time() - lease_seconds
+        reclaimed = 0
+        for entry in os.scandir(self.folders['claimed']):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                if entry.stat().st_mtime >= cutoff:
+                    continue
+                os.rename(entry.path, os.path.join(self.folders['pending'], get_job_name(entry.name)))
+            except FileNotFoundError:
+                # Another worker finished or reclaimed it first
+                continue
+            logger.warning("Reclaimed %s, its lease ran out.", entry.name)
+            reclaimed += 1
+        return reclaimed
+
+    # Function to record a finished job in the done or failed folder and release its claim
+    def finish(self, claim_path, job, state):
+        name = get_job_name(os.path.basename(claim_path))
+        write_json_atomically(self.folders['incoming'], os.path.join(self.folders[state], name), job)
+        try:
+            os.remove(claim_path)
+        except FileNotFoundError:
+            # The lease ran out while the job was running, another worker may run it again
+            logger.warning("The claim on %s was lost before it finished.", name)
+
+    # Function to move the failed jobs back to pending, for another try
+    def requeue_failed(self):
+        requeued = 0
+        for entry in os.scandir(self.folders['failed']):
+            if entry.name.endswith('.json'):
+                try:
+                    os.rename(entry.path, os.path.join(self.folders['pending'], entry.name))
+                    requeued += 1
+                except FileNotFoundError:
+                    continue
+        return requeued
+
+    # Function to put the copies that failed in otherwise done jobs back to pending, the copies that were saved stay done
+    def requeue_partial(self):
+        requeued = 0
+        for entry in os.scandir(self.folders['done']):
+            if not entry.name.endswith('.json'):
+                continue
+            # Moving the file out of done first makes sure only one requeue picks it up
+            temp_path = os.path.join(self.folders['incoming'], f"{entry.name}.{os.getpid()}.requeue")
+            try:
+                os.rename(entry.path, temp_path)
+            except FileNotFoundError:
+                continue
+            with open(temp_path, 'r', encoding='utf-8') as file:
+                job = json.load(file)
+            if job.get('failed_copies'):
+                retry = {key: value for key, value in job.items() if key not in ('saved_paths', 'failed_copies', 'worker', 'finished_at')}
+                retry['copies'] = job['failed_copies']
+                self.submit(entry.name, retry)
+                os.remove(temp_path)
+                requeued += 1
+            else:
+                os.replace(temp_path, entry.path)
+        return requeued
+
+# Function to write the prompt x copy jobs of a job file into the spool, one file per API request.
+# Jobs already in the spool (in any state) are left alone, so submitting the same file twice adds nothing
+def submit_jobs(spool, jobs):
+    known = spool.known_names()
+    submitted = 0
+    for job in jobs:
+        for prompt in PromptTemplate(job['prompt'], job['variables']).prompts():
+            copies = [(copy_index, make_job_id(prompt, copy_index, job['model_version'], job['size'], job['quality'], job['dataset']))
+                      for copy_index in range(job['quantity'])]
+            for batch in batch_copies(copies, job['model_version']):
+                name = f"{batch[0][1]}.json"
+                if name in known:
+                    continue
+                spool.submit(name, {
+                    'prompt': prompt,
+                    'copies': [copy_index for copy_index, _ in batch],
+                    'model_version': job['model_version'],
+                    'size': job['size'],
+                    'quality': job['quality'],
+                    'dataset': job['dataset'],
+                    'generate_log': job['generate_log'],
+                    'generate_caption': job['generate_caption'],
+                    'conceptify': job['conceptify'],
+                })
+                known.add(name)
+                submitted += 1
+    return submitted
+
+# Function to run one spooled job through the same generation and save path as the other engines,
+# concurrency is the worker's own and caps the adaptive concurrency controller
+def run_spooled_job(job, concurrency=None):
+    return create_images_thread(job['prompt'], len(job['copies']), job['size'], job['quality'], job['model_version'],
+                                job['generate_log'], job['generate_caption'], job['conceptify'], job['dataset'], concurrency=concurrency)
+
+# Function to pull jobs from the spool until it is empty (or forever with wait_for_jobs), running up to `concurrency` at a time
+def run_worker(spool, concurrency, lease_seconds=600.0, poll_interval=5.0, wait_for_jobs=False, stop_event=None):
+    worker_id = make_worker_id()
+    concurrency = max(1, concurrency)
+    use_worker_manifest(worker_id)
+    logger.info("Worker %s pulling jobs from %s with up to %d requests in flight.", worker_id, spool.path, concurrency)
+    clear_created_directories()
+    get_http_session(concurrency)
+    exporter = start_metrics_export(settings)
+    postprocessor = start_postprocessor(settings)
+
+    futures = {}
+    counts = {'done': 0, 'failed': 0}
+    last_renewal = last_reclaim = 0.0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            stopping = stop_event is not None and stop_event.is_set()
+
+            # Only claim what can run right away, so jobs are never held back behind this worker's own queue
+            claimed_any = False
+            while not stopping and len(futures) < concurrency:
+                claim = spool.claim(worker_id)
+                if claim is None:
+                    break
+                claim_path, job = claim
+                futures[executor.submit(run_spooled_job, job, concurrency)] = (claim_path, job)
+                claimed_any = True
+
+            now = time.monotonic()
+            if now - last_renewal >= lease_seconds / 3:
+                for claim_path in spool.renew([claim_path for claim_path, _ in futures.values()]):
+                    logger.warning("Lost the claim %s, its lease ran out.", os.path.basename(claim_path))
+                last_renewal = now
+            if now - last_reclaim >= lease_seconds / 2:
+                spool.reclaim_stale(lease_seconds)
+                last_reclaim = now
+
+            if not futures:
+                if stopping or (not claimed_any and not wait_for_jobs and not spool.counts()['claimed']):
+                    break
+                # While idle the output may be moved or cleaned up, so folders are created again for the next jobs
+                clear_created_directories()
+                time.sleep(poll_interval)
+                continue
+
+            done, _ = wait(futures, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                claim_path, job = futures.pop(future)
+                try:
+                    saved_paths = future.result()
+                except Exception as e:
+                    logger.error("Job failed for prompt: '%s': %s", job['prompt'], e, exc_info=True)
+                    saved_paths = [[] for _ in job['copies']]
+                if postprocessor:
+                    for copy_paths in saved_paths:
+                        for image_path in copy_paths:
+                            postprocessor.submit(image_path)
+                failed_copies = [copy_index for copy_index, copy_paths in zip(job['copies'], saved_paths) if not copy_paths]
+                metrics.increment('jobs_failed', len(failed_copies))
+                state = 'done' if len(failed_copies) < len(job['copies']) else 'failed'
+                counts[state] += 1
+                spool.finish(claim_path, dict(job, saved_paths=saved_paths, failed_copies=failed_copies, worker=worker_id, finished_at=time.time()), state)
+                logger.info("Progress: %d jobs done, %d failed by this worker.", counts['done'], counts['failed'])
+
+    wait_for_hedged_downloads()
+    flush_manifests()
+    if postprocessor:
+        postprocessor.close()
+    finish_metrics_export(exporter, settings)
+    logger.info("Worker %s finished: %d jobs done, %d failed.", worker_id, counts['done'], counts['failed'])
+    return counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Share generation jobs between any number of workers through a spool directory on shared storage.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    submit_parser = subparsers.add_parser('submit', help="Expand a job file into the spool, one job file per API request")
+    submit_parser.add_argument('spool', help="Spool directory, shared by the submitter and every worker")
+    submit_parser.add_argument('job_file', help="JSON job file, as for DallEBatch.py")
+    work_parser = subparsers.add_parser('work', help="Claim jobs from the spool and generate them")
+    work_parser.add_argument('spool', help="Spool directory, shared by the submitter and every worker")
+    work_parser.add_argument('--output', default='.', help="Folder the images are saved under, usually on the shared storage too")
+    work_parser.add_argument('--concurrency', type=int, default=settings['concurrency'], help="Requests this worker keeps in flight")
+    work_parser.add_argument('--lease', type=float, default=600.0, help="Seconds after which a claim that isn't renewed goes back to pending, e.g. after a crash")
+    work_parser.add_argument('--poll-interval', type=float, default=5.0, help="Seconds between checks for new jobs")
+    work_parser.add_argument('--wait', action='store_true', help="Keep waiting for new jobs instead of exiting once the spool is empty")
+    status_parser = subparsers.add_parser('status', help="Print the number of jobs in each state")
+    status_parser.add_argument('spool', help="Spool directory")
+    requeue_parser = subparsers.add_parser('requeue', help="Move the failed jobs back to pending")
+    requeue_parser.add_argument('spool', help="Spool directory")
+    requeue_parser.add_argument('--partial', action='store_true', help="Also requeue the failed copies of jobs that are done, e.g. one image of a DALL·E 2 batch")
+    args = parser.parse_args(argv)
+    setup_logging(settings['log_level'], settings['log_format'])
+
+    spool = Spool(os.path.abspath(args.spool))
+    if args.command == 'submit':
+        jobs = load_jobs(args.job_file)
+        for index, job in enumerate(jobs, start=1):
+            total_images, total_cost = estimate_job(job)
+            logger.info("Job %d/%d: %d images, approximately $%.2f.", index, len(jobs), total_images, total_cost)
+        print(f"Submitted {submit_jobs(spool, jobs)} requests to {spool.path}.")
+    elif args.command == 'work':
+        mark_startup_phase('spool')
+        report_startup()
+        # Images are saved relative to the working directory, like in the other modes
+        os.makedirs(args.output, exist_ok=True)
+        os.chdir(args.output)
+        counts = run_worker(spool, args.concurrency, args.lease, args.poll_interval, args.wait)
+        return 1 if counts['failed'] else 0
+    elif args.command == 'requeue':
+        print(f"Moved {spool.requeue_failed()} failed jobs back to pending.")
+        if args.partial:
+            print(f"Requeued the failed copies of {spool.requeue_partial()} done jobs.")
+    else:
+        print(', '.join(f"{name} {count}" for name, count in spool.counts().items()))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
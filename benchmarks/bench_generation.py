@@ -0,0 +1,193 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+# Run from anywhere: the generator modules live one folder up
+BENCH_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REPO_DIRECTORY = os.path.dirname(BENCH_DIRECTORY)
+sys.path.insert(0, REPO_DIRECTORY)
+from mock_images_api import MockImagesAPI, add_server_arguments
+
+# Where benchmark results are saved by default
+RESULTS_DIRECTORY = os.path.join(BENCH_DIRECTORY, 'results')
+
+# Prefix of the line a worker process reports its result on
+RESULT_PREFIX = 'BENCH_RESULT '
+
+# Function to read the peak resident memory of this process in MB, None where it can't be measured
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        info = psutil.Process().memory_info()
+        return round(getattr(info, 'peak_wset', info.rss) / 2 ** 20, 1)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024, 1)
+
+# Function to run one benchmark level in this (fresh) process, through the real generation and persistence path
+def run_worker(config):
+    # The generator reads settings.ini from the working directory, so give it one pointed at the mock server
+    os.chdir(config['directory'])
+    with open('settings.ini', 'w') as file:
+        file.write("[openai]\napi_key = sk-benchmark\n\n[defaults]\n"
+                   f"images_per_minute = 0\nmax_retries = 10\nresponse_format = {config['response_format']}\n"
+                   f"manifest = {config['manifest']}\nadaptive_concurrency = {config.get('adaptive', False)}\nlog_level = WARNING\n")
+    os.environ['OPENAI_BASE_URL'] = config['base_url']
+    from DallECore import settings, run_generation
+    from DallEMetrics import metrics, setup_logging
+    setup_logging(settings['log_level'], settings['log_format'])
+
+    # The images are spread over prompts of `quantity` copies each, DALL·E 2 batches those copies into fewer requests
+    quantity = config.get('quantity', 1)
+    variables = {'INDEX': [f"number {index}" for index in range(max(1, config['images'] // quantity))]}
+    start = time.perf_counter()
+    completed, failed_jobs = run_generation("benchmark image [INDEX]", variables, quantity, '1024x1024', 'standard', config['model_version'],
+                                            True, True, False, 'bench', config['concurrency'], engine=config['engine'])
+    seconds = time.perf_counter() - start
+
+    summary = metrics.summary()
+    latency = summary['latency']
+    result = {
+        'engine': config['engine'],
+        'concurrency': config['concurrency'],
+        'images': completed,
+        'failed': len(failed_jobs),
+        'seconds': round(seconds, 3),
+        'images_per_minute': round(completed / seconds * 60, 1),
+        'requests': summary['counters']['requests'],
+        'retries': summary['counters']['retries'],
+        'rate_limited': summary['counters']['rate_limited'],
+        'concurrency_limits': {combination: limits['limit'] for combination, limits in summary['concurrency'].items()},
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    for stage in ('api', 'download', 'write'):
+        result[f'{stage}_p50'] = latency.get(stage, {}).get('p50')
+        result[f'{stage}_p99'] = latency.get(stage, {}).get('p99')
+    print(RESULT_PREFIX + json.dumps(result), flush=True)
+    return 0
+
+# Function to run one level in a child process, so every level starts cold and gets its own peak RSS
+def run_level(config):
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', json.dumps(config)],
+                               capture_output=True, text=True)
+    for line in completed.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise RuntimeError(f"Benchmark worker failed (exit code {completed.returncode}):\n{completed.stdout}\n{completed.stderr}")
+
+# Function to get the short git revision of the tree being measured
+def get_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIRECTORY, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+# Function to format a latency in milliseconds, or '-' when the stage didn't run
+def format_ms(seconds):
+    return f"{seconds * 1000:.0f}" if seconds is not None else '-'
+
+# Function to print the results as a table
+def print_results(results):
+    print(f"{'engine':<8} {'conc':>4} {'images':>6} {'failed':>6} {'img/min':>8} {'api p50/p99 ms':>15} {'dl p50/p99 ms':>14} {'retries':>7} {'rss MB':>7}")
+    for result in results:
+        print(f"{result['engine']:<8} {result['concurrency']:>4} {result['images']:>6} {result['failed']:>6} {result['images_per_minute']:>8.1f} "
+              f"{format_ms(result['api_p50']) + '/' + format_ms(result['api_p99']):>15} "
+              f"{format_ms(result['download_p50']) + '/' + format_ms(result['download_p99']):>14} "
+              f"{result['retries']:>7} {result['peak_rss_mb'] if result['peak_rss_mb'] is not None else '-':>7}")
+
+# Function to print how throughput, p99 and memory changed against an earlier results file
+def print_comparison(results, baseline_path):
+    with open(baseline_path, 'r', encoding='utf-8') as file:
+        baseline = json.load(file)
+    previous = {(result['engine'], result['concurrency']): result for result in baseline['results']}
+    print(f"Compared with {baseline.get('label') or baseline.get('revision')} ({baseline_path}):")
+    for result in results:
+        before = previous.get((result['engine'], result['concurrency']))
+        if not before:
+            continue
+        change = lambda key: (result[key] - before[key]) / before[key] * 100 if before.get(key) and result.get(key) is not None else 0.0
+        print(f"  {result['engine']} x{result['concurrency']}: throughput {change('images_per_minute'):+.1f}%, "
+              f"api p99 {change('api_p99'):+.1f}%, peak RSS {change('peak_rss_mb'):+.1f}%")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark image generation against a local mock Images API.")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--images', type=int, default=64, help="Images to generate at every level")
+    parser.add_argument('--concurrency', default='1,4,16', help="Comma separated concurrency levels")
+    parser.add_argument('--engine', default='threads', help="Comma separated engines to run: threads, asyncio")
+    parser.add_argument('--quantity', type=int, default=1, help="Copies of each prompt, DALL·E 2 requests up to 10 of them at once")
+    parser.add_argument('--model-version', default='DALLE3', choices=['DALLE2', 'DALLE3'], help="Model version to request")
+    parser.add_argument('--response-format', default='url', choices=['url', 'b64_json'], help="Response format to request")
+    parser.add_argument('--adaptive', action='store_true', help="Let the adaptive concurrency controller tune the requests in flight, the levels become its ceiling")
+    parser.add_argument('--manifest', action='store_true', help="Write a manifest instead of per-image sidecar files")
+    parser.add_argument('--label', default='', help="Name stored with the results, e.g. the branch being measured")
+    parser.add_argument('--output', default=None, help=f"Results file to write (default: a new file in {RESULTS_DIRECTORY})")
+    parser.add_argument('--compare', default=None, help="Earlier results file to compare against")
+    parser.add_argument('--keep-images', action='store_true', help="Keep the generated files instead of deleting them after each level")
+    add_server_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        return run_worker(json.loads(args.worker))
+
+    api = MockImagesAPI(latency=args.latency, download_latency=args.download_latency, rate_limit=args.rate_limit,
+                        retry_after=args.retry_after, payload_kb=args.payload_kb, drop_rate=args.drop_rate,
+                        max_in_flight=args.max_in_flight).start()
+    print(f"Mock Images API on {api.base_url}: latency {args.latency}, download latency {args.download_latency}, "
+          f"{args.rate_limit:.0%} 429s, {args.payload_kb}KB images")
+
+    results = []
+    try:
+        for engine in args.engine.split(','):
+            for concurrency in [int(level) for level in args.concurrency.split(',')]:
+                directory = tempfile.mkdtemp(prefix='dalle-bench-')
+                try:
+                    result = run_level({'base_url': api.base_url, 'directory': directory, 'engine': engine.strip(), 'concurrency': concurrency,
+                                        'images': args.images, 'quantity': args.quantity, 'model_version': args.model_version,
+                                        'response_format': args.response_format, 'manifest': args.manifest, 'adaptive': args.adaptive})
+                finally:
+                    if args.keep_images:
+                        print(f"Images of {engine} x{concurrency} kept in {directory}")
+                    else:
+                        shutil.rmtree(directory, ignore_errors=True)
+                results.append(result)
+                print(f"{engine} x{concurrency}: {result['images']} images in {result['requests']} requests at {result['images_per_minute']:.1f}/min")
+    finally:
+        api.stop()
+
+    print()
+    print_results(results)
+
+    # Save the results so later versions can be compared against them
+    revision = get_revision()
+    output = args.output or os.path.join(RESULTS_DIRECTORY, f"bench-{datetime.now():%Y%m%d-%H%M%S}-{revision}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump({
+            'label': args.label,
+            'revision': revision,
+            'timestamp': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'options': {key: value for key, value in vars(args).items() if key not in ('worker', 'output', 'compare')},
+            'results': results,
+        }, file, indent=2)
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        print_comparison(results, args.compare)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
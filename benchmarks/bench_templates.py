@@ -0,0 +1,58 @@
+import os
+import sys
+import time
+import argparse
+from itertools import product
+
+# Run from anywhere: the generator modules live one folder up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from DallECore import PromptTemplate, split_concept
+
+TEMPLATE = ("Envision a [SUBJECT], with an ultra-modern aesthetic, hi-tech design, characterized by a sleek silhouette and "
+            "aggressive geometry, placed in a [SETTING] under [LIGHTING]. Inspired by the dark knight.")
+
+# Function to build variable lists of the requested size, every subject carries a concept tag
+def build_variables(values_per_variable):
+    return {
+        'SUBJECT': [f"[Subject{index}] subject number {index}" for index in range(values_per_variable)],
+        'SETTING': [f"setting number {index}" for index in range(values_per_variable)],
+        'LIGHTING': [f"lighting number {index}" for index in range(values_per_variable)],
+    }
+
+# The rendering used before templates were precompiled: a str.replace chain, then the concept regex on every prompt
+def render_replace_chain(base_prompt, variables, conceptify):
+    keys, values = zip(*variables.items())
+    for combination in product(*values):
+        permuted_prompt = base_prompt
+        for var, val in zip(keys, combination):
+            permuted_prompt = permuted_prompt.replace(f'[{var}]', val)
+        yield permuted_prompt, split_concept(permuted_prompt) if conceptify else None
+
+# Function to time how long it takes to drain a prompt generator
+def time_render(jobs):
+    start = time.perf_counter()
+    count = 0
+    for _ in jobs:
+        count += 1
+    return count, time.perf_counter() - start
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark prompt template rendering.")
+    parser.add_argument('--values', type=int, default=50, help="Values per variable, the template has 3 variables (50 -> 125k prompts)")
+    args = parser.parse_args(argv)
+
+    variables = build_variables(args.values)
+    for conceptify in (False, True):
+        parse_start = time.perf_counter()
+        template = PromptTemplate(TEMPLATE, variables)
+        parse_seconds = time.perf_counter() - parse_start
+
+        count, chain_seconds = time_render(render_replace_chain(TEMPLATE, variables, conceptify))
+        _, compiled_seconds = time_render(template.jobs(conceptify))
+        print(f"conceptify={conceptify}: {count} prompts, parse {parse_seconds * 1000:.2f}ms, "
+              f"replace chain {chain_seconds / count * 1e6:.2f}us/prompt, "
+              f"precompiled {compiled_seconds / count * 1e6:.2f}us/prompt ({chain_seconds / compiled_seconds:.1f}x)")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
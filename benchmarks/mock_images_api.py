@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import time
+import zlib
+import base64
+import struct
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Function to parse a latency distribution: fixed:SECONDS, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA
+def parse_latency(spec):
+    kind, _, args = spec.partition(':')
+    values = [float(value) for value in args.split(',') if value]
+    if kind == 'fixed' and len(values) == 1:
+        return lambda: values[0]
+    if kind == 'uniform' and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'lognormal' and len(values) == 2:
+        median, sigma = values
+        return lambda: random.lognormvariate(0, sigma) * median
+    raise ValueError(f"Unknown latency distribution '{spec}', use fixed:SECONDS, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA")
+
+# Function to build one PNG chunk
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+# Function to build a valid PNG of roughly the requested size, filled with noise so it doesn't compress.
+# Returns (head, body): every image gets its own id chunk between the two, so no two images are identical
+def build_png(payload_bytes):
+    width = 256
+    row = width * 3 + 1
+    height = max(1, payload_bytes // row)
+    raw = b''.join(b'\x00' + os.urandom(width * 3) for _ in range(height))
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', header), png_chunk(b'IDAT', zlib.compress(raw, 0)) + png_chunk(b'IEND', b'')
+
+# Function to make a new image id, 15 hex digits
+def new_image_id():
+    return f"{random.getrandbits(60):015x}"
+
+# Function to build the id chunk that makes an image unique, 30 bytes so base64 of head + id ends on a 3 byte boundary
+def id_chunk(image_id=None):
+    return png_chunk(b'tEXt', b'id\x00' + (image_id or new_image_id()).encode('ascii'))
+
+# Local stand-in for the Images API: /v1/images/generations plus the image URLs it hands out
+class MockImagesAPI(object):
+    def __init__(self, host='127.0.0.1', port=0, latency='fixed:0.05', download_latency='fixed:0', rate_limit=0.0, retry_after=0.1, payload_kb=256, rejected_keys=(), drop_rate=0.0, max_in_flight=0):
+        self.latency = parse_latency(latency)
+        self.download_latency = parse_latency(download_latency)
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.drop_rate = drop_rate  # Fraction of image downloads cut off halfway, to exercise retries and resumed downloads
+        self.max_in_flight = max_in_flight  # Generation requests past this many at once get a 429, like an account's concurrency cap, 0 for no cap
+        self.in_flight = 0
+        self.rejected_keys = set(rejected_keys)  # API keys answered with a 401, to exercise the key pool's health tracking
+        self.png_head, self.png_body = build_png(payload_kb * 1024)
+        self.png_body_b64 = base64.b64encode(self.png_body).decode('ascii')
+        self.counts = {'generations': 0, 'rate_limited': 0, 'images': 0, 'downloads': 0, 'dropped': 0, 'resumed': 0}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.build_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    # Function to get the bytes of an image, the same id always gives the same bytes so downloads can be resumed
+    def image(self, image_id=None):
+        return self.png_head + id_chunk(image_id) + self.png_body
+
+    # Function to get a fresh unique image as base64, only the small head is encoded per image
+    def image_b64(self):
+        return base64.b64encode(self.png_head + id_chunk()).decode('ascii') + self.png_body_b64
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    # Function to admit a generation request, False once max_in_flight requests are already being served
+    def enter(self):
+        with self.lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def build_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, body, headers=None):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                if self.path.rstrip('/') != '/v1/images/generations':
+                    return self.send_json(404, {'error': {'message': f"Unknown path {self.path}", 'type': 'invalid_request_error'}})
+                api.count('generations')
+                if self.headers.get('Authorization', '').replace('Bearer ', '', 1) in api.rejected_keys:
+                    return self.send_json(401, {'error': {'message': "Incorrect API key provided", 'type': 'invalid_request_error', 'code': 'invalid_api_key'}})
+                if random.random() < api.rate_limit or not api.enter():
+                    api.count('rate_limited')
+                    return self.send_json(429, {'error': {'message': "Rate limit reached for images per minute", 'type': 'requests'}},
+                                          {'Retry-After': str(api.retry_after)})
+                try:
+                    n = int(body.get('n', 1))
+                    if n > 1 and body.get('model') == 'dall-e-3':
+                        return self.send_json(400, {'error': {'message': "dall-e-3 only supports n=1", 'type': 'invalid_request_error'}})
+                    time.sleep(api.latency())
+                finally:
+                    api.leave()
+                api.count('images', n)
+                if body.get('response_format') == 'b64_json':
+                    data = [{'b64_json': api.image_b64(), 'revised_prompt': body.get('prompt')} for _ in range(n)]
+                else:
+                    host, port = api.server.server_address[:2]
+                    data = [{'url': f"http://{host}:{port}/images/{new_image_id()}.png", 'revised_prompt': body.get('prompt')} for _ in range(n)]
+                self.send_json(200, {'created': int(time.time()), 'data': data})
+
+            def do_GET(self):
+                if not self.path.startswith('/images/'):
+                    return self.send_json(404, {'error': {'message': f"Unknown path {self.path}"}})
+                time.sleep(api.download_latency())
+                api.count('downloads')
+                image = api.image(os.path.splitext(os.path.basename(self.path))[0])
+
+                # Resumed downloads ask for the rest of the image with a Range header
+                range_header = self.headers.get('Range', '')
+                start = int(range_header[len('bytes='):].split('-')[0]) if range_header.startswith('bytes=') else 0
+                if start >= len(image):
+                    self.send_response(416)
+                    self.send_header('Content-Range', f"bytes */{len(image)}")
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if start:
+                    api.count('resumed')
+                    self.send_response(206)
+                    self.send_header('Content-Range', f"bytes {start}-{len(image) - 1}/{len(image)}")
+                else:
+                    self.send_response(200)
+                body = image[start:]
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if random.random() < api.drop_rate:
+                    # Send half the image and hang up, like a dropped connection
+                    api.count('dropped')
+                    self.wfile.write(body[:len(body) // 2])
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+        return Handler
+
+    # Function to serve in a background thread, for use from the benchmark harness
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread:
+            self.server.shutdown()
+        self.server.server_close()
+
+# Function to add the server options to an argument parser, shared with the benchmark harness
+def add_server_arguments(parser):
+    parser.add_argument('--latency', default='lognormal:0.5,0.3', help="Generation latency: fixed:SECONDS, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA")
+    parser.add_argument('--download-latency', default='fixed:0.02', help="Latency before an image URL starts sending, same format as --latency")
+    parser.add_argument('--rate-limit', type=float, default=0.05, help="Fraction of generation requests answered with a 429")
+    parser.add_argument('--retry-after', type=float, default=0.1, help="Retry-After seconds sent with the injected 429s")
+    parser.add_argument('--max-in-flight', type=int, default=0, help="Answer generation requests past this many at once with a 429, 0 for no cap")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="Fraction of image downloads cut off halfway")
+    parser.add_argument('--payload-kb', type=int, default=1024, help="Size of the PNG returned for every image")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the OpenAI Images API.")
+    parser.add_argument('--port', type=int, default=8000, help="Port to listen on")
+    parser.add_argument('--reject-keys', default='', help="Comma separated API keys to answer with a 401")
+    add_server_arguments(parser)
+    args = parser.parse_args(argv)
+
+    api = MockImagesAPI(port=args.port, latency=args.latency, download_latency=args.download_latency,
+                        rate_limit=args.rate_limit, retry_after=args.retry_after, payload_kb=args.payload_kb,
+                        drop_rate=args.drop_rate, max_in_flight=args.max_in_flight, rejected_keys=[key for key in args.reject_keys.split(',') if key])
+    print(f"Serving the mock Images API, point the generator at it with OPENAI_BASE_URL={api.base_url}")
+    try:
+        api.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"Served: {api.counts}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
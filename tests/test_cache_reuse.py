@@ -0,0 +1,49 @@
+import os
+import sys
+import glob
+import pytest
+
+# The generator modules live one folder up, the mock Images API in benchmarks/
+TESTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REPO_DIRECTORY = os.path.dirname(TESTS_DIRECTORY)
+sys.path.insert(0, REPO_DIRECTORY)
+sys.path.insert(0, os.path.join(REPO_DIRECTORY, 'benchmarks'))
+
+import DallECore
+from mock_images_api import MockImagesAPI
+
+@pytest.fixture
+def mock_api(tmp_path, monkeypatch):
+    api = MockImagesAPI(latency='fixed:0', rate_limit=0, payload_kb=4).start()
+    monkeypatch.setenv('OPENAI_BASE_URL', api.base_url)
+    monkeypatch.chdir(tmp_path)
+    # A fresh unpaced key pool, so its clients point at the mock server
+    monkeypatch.setattr(DallECore, 'key_pool', DallECore.build_key_pool(dict(DallECore.settings, images_per_minute=0)))
+    yield api
+    api.stop()
+
+# Function to run a small job with the image cache on, for the given dataset and engine
+def run_job(dataset, engine, cache_path):
+    return DallECore.run_generation("a [SUBJECT]", {'SUBJECT': ['cat', 'dog']}, 1, '1024x1024', 'standard', 'DALLE3',
+                                    True, True, False, dataset, 2, cache_path=cache_path, engine=engine)
+
+# Function to count the images saved in a dataset folder
+def count_images(dataset):
+    return len(glob.glob(os.path.join('*', dataset, '**', '*.png'), recursive=True))
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_rerun_into_second_dataset_links_cached_images_once(mock_api, tmp_path, engine):
+    cache_path = str(tmp_path / 'cache.db')
+    assert run_job('ds', engine, cache_path) == (2, [])
+    assert mock_api.counts['generations'] == 2
+
+    # The first run into ds2 links the cached images in, the second one finds them there
+    for _ in range(2):
+        run_job('ds2', engine, cache_path)
+        assert count_images('ds2') == 2
+        assert len(glob.glob(os.path.join('*', 'ds2', '*.txt'))) == 2
+
+    # Rerunning into the dataset the images were generated for adds nothing either
+    run_job('ds', engine, cache_path)
+    assert count_images('ds') == 2
+    assert mock_api.counts['generations'] == 2
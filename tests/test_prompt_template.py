@@ -0,0 +1,22 @@
+import os
+import sys
+import pytest
+
+# The generator modules live one folder up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from DallECore import PromptTemplate
+
+VARIABLES = {'A': ['1', '2', '3'], 'B': ['x', 'y'], 'C': ['p', 'q', 'r', 's']}
+
+@pytest.mark.parametrize('compiled', [True, False])
+def test_prompts_from_any_start_match_the_full_expansion(compiled):
+    template = PromptTemplate("a [A] [B] of [C]", VARIABLES)
+    full = list(template.prompts())
+    template.compiled = compiled
+    for start in range(template.count() + 2):
+        assert list(template.prompts(start)) == full[start:]
+
+def test_prompt_at_matches_the_full_expansion():
+    template = PromptTemplate("a [A] [B] of [C]", VARIABLES)
+    assert [template.prompt_at(index) for index in range(template.count())] == list(template.prompts())